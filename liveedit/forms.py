@@ -1,6 +1,9 @@
 from django import forms
 from django.contrib.contenttypes.models import ContentType
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
 from django.utils import timezone
 
 import wagtail
@@ -11,8 +14,24 @@ else:
     from wagtail.models import Page
     from wagtail.blocks.stream_block import StreamValue
 
+try:
+    # Wagtail >= 4.0
+    from wagtail.models import DraftStateMixin, RevisionMixin
+except ImportError:
+    DraftStateMixin = RevisionMixin = None
+
+import copy
+import json
+
+from .side_effects import defer_side_effects
+from .utils import get_stream_version, is_draft_mode
+
 
 class BlockAppendForm(forms.Form):
+    # Whether only the StreamField needs to be loaded from a draft revision
+    # (see get_latest_revision_and_save_function)
+    load_field_only = True
+
     content_type_id = forms.IntegerField()
     object_id = forms.IntegerField()
     object_field = forms.CharField()
@@ -31,8 +50,21 @@ class BlockAppendForm(forms.Form):
             raise forms.ValidationError("Invalid content type")
 
         model_class = cleaned_data['content_type'].model_class()
+        queryset = model_class.objects.all()
+        if (
+            issubclass(model_class, Page) or (RevisionMixin is not None and issubclass(model_class, RevisionMixin))
+        ) and hasattr(model_class, 'latest_revision'):
+            # Wagtail >= 4.0: fetch the latest revision along with the object
+            queryset = queryset.select_related('latest_revision')
+        connection = transaction.get_connection()
+        if self.request.method=='POST' and connection.in_atomic_block:
+            # Lock the object's row until the change is saved, so that the
+            # version of its content can't change after being checked
+            queryset = queryset.select_for_update(
+                **({'of': ('self',)} if connection.features.has_select_for_update_of else {})
+            )
         try:
-            cleaned_data['object'] = model_class.objects.get(pk=cleaned_data['object_id'])
+            cleaned_data['object'] = queryset.get(pk=cleaned_data['object_id'])
         except model_class.DoesNotExist:
             raise forms.ValidationError("Invalid object")
 
@@ -44,6 +76,8 @@ class BlockAppendForm(forms.Form):
         cleaned_data['revision'], cleaned_data['save'] = get_latest_revision_and_save_function(
             cleaned_data['object'], 
             self.request,
+            cleaned_data['object_field'],
+            self.load_field_only,
         )
 
         cleaned_data['value'] = getattr(cleaned_data['revision'], cleaned_data['object_field'], None)
@@ -51,6 +85,8 @@ class BlockAppendForm(forms.Form):
         if not isinstance(cleaned_data['value'], StreamValue):
             raise forms.ValidationError("Expected a StreamValue, got %r" % cleaned_data['value'])
 
+        cleaned_data['version'] = get_stream_version(cleaned_data['value'])
+
         return cleaned_data
 
 
@@ -59,43 +95,184 @@ class BlockEditForm(BlockAppendForm):
     id = forms.CharField()
 
 
+class BlockRenderForm(BlockEditForm):
+    # Blocks may be rendered using any of the object's fields, so load all of
+    # them from a draft revision
+    load_field_only = False
+
+
 class BlockActionForm(BlockEditForm):
     action = forms.CharField()
-    redirect_url = forms.CharField()
+    redirect_url = forms.CharField(required=False)
 
 
-def get_latest_revision_and_save_function(obj, request):
+class BlockBatchForm(BlockAppendForm):
+    operations = forms.CharField()
+
+    def clean_operations(self):
+        try:
+            operations = json.loads(self.cleaned_data['operations'])
+        except ValueError:
+            operations = None
+
+        if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+            raise forms.ValidationError("Expected a JSON list of operations")
+
+        return operations
+
+
+def get_revision_field_object(revision, obj, field_name):
+    """
+    Return a copy of the object, with just the named field's value loaded from
+    the revision's content, rather than deserialising all of its fields and
+    child relations with `as_object`.
+
+    Returns None if the field can't be loaded on its own, eg because the
+    revision's content isn't stored as a dict (Wagtail < 4.0).
+    """
+    content = getattr(revision, 'content', None)
+    if not isinstance(content, dict) or field_name not in content:
+        return None
+
+    field = obj._meta.get_field(field_name)
+    draft = copy.copy(obj)
+    setattr(draft, field.attname, field.to_python(content[field_name]))
+    draft._live_edit_revision_id = revision.id
+    return draft
+
+
+def has_revisions(obj):
+    """
+    Whether the object keeps revisions, ie is a page, or a model (such as a
+    snippet) using RevisionMixin.
+    """
+    return isinstance(obj, Page) or (RevisionMixin is not None and isinstance(obj, RevisionMixin))
+
+
+def has_drafts(obj):
+    """
+    Whether the object can have unpublished drafts, ie is a page, or a model
+    using DraftStateMixin.
+    """
+    return isinstance(obj, Page) or (DraftStateMixin is not None and isinstance(obj, DraftStateMixin))
+
+
+def save_revision_field(revision, obj, field_name):
+    """
+    Update a revision with the object's current value of the named field. The
+    field is patched into the stored content where possible (Wagtail >= 4.0),
+    rather than re-serialising the whole object.
+    """
+    if field_name and isinstance(getattr(revision, 'content', None), dict):
+        field = obj._meta.get_field(field_name)
+        revision.content[field_name] = field.value_to_string(obj)
+        revision.save(update_fields=['content'])
+    else:
+        revision.content = obj.serializable_data()
+        revision.save()
+
+
+def get_latest_revision_and_save_function(obj, request, field_name=None, load_field_only=False):
     """
     For a given model instance, return the latest revision of that model
     instance, as well as a function which saves it, as a tuple.
+
+    The save function returns the id of the revision holding the saved
+    changes, if there is one.
+
+    If `field_name` is given, only that field is expected to change, so only
+    that field is written when saving a model other than a page, and only that
+    field is re-serialised when a revision is updated. With `load_field_only`,
+    only that field is loaded from a draft revision too, and the object's other
+    fields are those of the live object.
+
+    Snippets (and other models) with revisions and drafts are treated just like
+    pages. In draft mode (see `is_draft_mode`), changes to published objects
+    are saved into a new draft, which later changes are then merged into.
+
+    The side effects of saving, such as search indexing, are deferred (see
+    `liveedit.side_effects`).
     """
 
-    # The default behaviour is to update the current live page
-    def save():
+    def save_object():
         obj.last_published_at = timezone.now()
-        obj.save()
+        if field_name and not isinstance(obj, Page):
+            # Only write the changed field, rather than every column
+            update_fields = [field_name]
+            try:
+                obj._meta.get_field('last_published_at')
+                update_fields.append('last_published_at')
+            except FieldDoesNotExist:
+                pass
+            obj.save(update_fields=update_fields)
+        else:
+            obj.save()
+
+    # The default behaviour is to update the current live object
+    def save():
+        save_object()
+        return getattr(obj, 'latest_revision_id', None)
+
+    if has_revisions(obj):
+        # Load the latest revision once, it's needed by every branch below
+        revision = obj.get_latest_revision()
 
-    if isinstance(obj, Page):
-        if obj.has_unpublished_changes:
+        if getattr(obj, 'has_unpublished_changes', False):
             # Modify the latest draft, not the published one
-            obj = obj.get_latest_revision_as_object()
+            draft = None
+            if field_name and load_field_only:
+                draft = get_revision_field_object(revision, obj, field_name)
+
+            if draft is not None:
+                obj = draft
+            elif hasattr(revision, 'as_object'):
+                # Wagtail >= 5.0
+                obj = revision.as_object()
+            else:
+                obj = revision.as_page_object()
 
             def save():
                 # Update the existing draft revision
-                rev = obj.get_latest_revision()
-                rev.content = obj.serializable_data()
-                rev.save()
+                save_revision_field(revision, obj, field_name)
+                return revision.id
+
+        elif has_drafts(obj) and is_draft_mode(request):
+            # Start a new draft, to be published later
+            def save():
+                return obj.save_revision(user=request.user).id
 
         elif (
-            not obj.get_latest_revision()
-            or obj.get_latest_revision().user != request.user
-            or (timezone.now() - obj.get_latest_revision().created_at).total_seconds() >= 3600
+            not revision
+            or revision.user_id != request.user.pk
+            or (timezone.now() - revision.created_at).total_seconds() >= 3600
         ):
-            # Create and publish a new revision
+            if has_drafts(obj):
+                # Create and publish a new revision
+                def save():
+                    rev = obj.save_revision(user=request.user)
+                    rev.publish(user=request.user)
+                    return rev.id
+            else:
+                # Without drafts, the object is saved directly, with a new
+                # revision recording the change
+                def save():
+                    save_object()
+                    return obj.save_revision(user=request.user).id
+
+        elif not has_drafts(obj):
+            # Without drafts, the admin edits the latest revision rather than
+            # the live object, so merge the change into both
             def save():
-                obj.save_revision(user=request.user).publish(user=request.user)
+                save_object()
+                save_revision_field(revision, obj, field_name)
+                return revision.id
 
-    return obj, save
+    def save_deferring_side_effects():
+        # Reindexing and cache purging are done later, once per burst of edits
+        with defer_side_effects():
+            return save()
+
+    return obj, save_deferring_side_effects
 
 
 def check_can_edit(user, obj, field_name):
@@ -110,12 +287,64 @@ def check_can_edit(user, obj, field_name):
     elif not user.has_perm("%s.change" % obj._meta.app_label):
         raise PermissionDenied
 
-    # For pages and snippets, check the requested field is present on the normal edit panel.
-    # TODO: apply similar scrutiny to modeladmin models?
+    editable_fields = get_editable_fields(type(obj))
+    if editable_fields is not None and field_name not in editable_fields:
+        raise PermissionDenied
+
 
-    if isinstance(obj, Page):
-        if field_name not in obj.get_edit_handler().get_form_options()['fields']:
-            raise PermissionDenied
-    elif hasattr(obj, 'snippet_viewset'):
-        if field_name not in obj.snippet_viewset.get_edit_handler().get_form_options()['fields']:
+def check_can_publish(user, obj):
+    """
+    Check whether the supplied user has permission to publish the supplied
+    object's drafts.
+    """
+
+    if hasattr(obj, 'permissions_for_user'):
+        if not obj.permissions_for_user(user).can_publish():
             raise PermissionDenied
+    elif not user.has_perm("%s.publish_%s" % (obj._meta.app_label, obj._meta.model_name)):
+        raise PermissionDenied
+
+
+_editable_fields_cache = {}
+
+def get_editable_fields(model_class):
+    """
+    Return the set of names of the fields on the model's normal edit panel, or
+    None if the model has no edit panel to check against.
+
+    Building edit handlers is expensive, so the result is cached per model
+    (until a setting changes, which may alter the panels).
+    """
+
+    try:
+        return _editable_fields_cache[model_class]
+    except KeyError:
+        pass
+
+    if issubclass(model_class, Page):
+        edit_handler = model_class.get_edit_handler()
+    elif hasattr(model_class, 'snippet_viewset'):
+        edit_handler = model_class.snippet_viewset.get_edit_handler()
+    elif hasattr(model_class, 'panels') or hasattr(model_class, 'edit_handler'):
+        # eg, modeladmin models, which use the panels defined on the model
+        try:
+            # Wagtail >= 4.0
+            from wagtail.admin.panels import get_edit_handler
+            edit_handler = get_edit_handler(model_class)
+        except ImportError:
+            edit_handler = None
+    else:
+        edit_handler = None
+
+    if edit_handler is None:
+        fields = None
+    else:
+        fields = frozenset(edit_handler.get_form_options()['fields'])
+
+    _editable_fields_cache[model_class] = fields
+    return fields
+
+
+@receiver(setting_changed)
+def clear_editable_fields_cache(**kwargs):
+    _editable_fields_cache.clear()
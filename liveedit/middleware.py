@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core import signing
+from django.utils.functional import SimpleLazyObject, empty
+
+from .utils import get_editor_cookie_settings
+
+def _get_loaded_user(request):
+    """
+    Return the request's user if something has already loaded it (eg, an admin
+    view, or logging in or out), or None otherwise.
+    """
+    user = request.__dict__.get('user')
+    if isinstance(user, SimpleLazyObject):
+        if user._wrapped is empty:
+            return None
+        return user._wrapped
+    return user
+
+class EditorCookieMiddleware:
+    """
+    Maintain the "editor present" cookie checked by
+    `liveedit.utils.is_editor_cookie_present`.
+
+    The cookie is set (or refreshed, once half its age has passed) for admin
+    users and deleted for anyone else, but only on responses which have
+    already loaded the user, so this never loads the session itself. It should
+    be placed after `AuthenticationMiddleware`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        user = _get_loaded_user(request)
+        if user is None:
+            return response
+
+        name, salt, max_age = get_editor_cookie_settings()
+
+        if user.is_authenticated and user.has_perm('wagtailadmin.access_admin'):
+            try:
+                request.get_signed_cookie(name, salt=salt, max_age=max_age // 2)
+            except (KeyError, signing.BadSignature):
+                response.set_signed_cookie(
+                    name, '1', salt=salt, max_age=max_age,
+                    secure=settings.SESSION_COOKIE_SECURE,
+                    samesite='Lax',
+                )
+        elif name in request.COOKIES:
+            response.delete_cookie(name, samesite='Lax')
+
+        return response
@@ -0,0 +1,158 @@
+from django.contrib.contenttypes.models import ContentType
+from django.urls import reverse
+
+try:
+    # Wagtail >= 5.0
+    from wagtail.models import Page
+except ImportError:
+    from wagtail.core.models import Page
+
+from collections import defaultdict
+
+
+class EditPermissionResolver:
+    """
+    Determines whether a request's user may live edit the blocks of objects.
+
+    Verdicts are memoized for the lifetime of the resolver (see
+    `get_permission_resolver`), so are computed once per object however many
+    of its blocks are rendered. Objects referenced by block markers can be
+    resolved as a batch with `resolve_references`, which loads them with one
+    query per model. Permission lookups are shared between objects too, since
+    Wagtail and Django cache the user's permissions on the user object.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.verdicts = {}
+
+    def is_editing_allowed(self, obj):
+        """
+        Return a tuple of (whether the user may live edit the object, the URL
+        of the latest draft if editing isn't allowed because the object isn't
+        the latest draft).
+        """
+        return self._get_verdict(
+            obj,
+            getattr(obj, '_live_edit_revision_id', None),
+            getattr(obj, '_live_edit_is_preview', False),
+        )
+
+    def resolve_references(self, references):
+        """
+        Resolve a list of references to objects, as dicts with the
+        `content_type_id`, `object_id` and optional `revision_id` and `preview`
+        keys from block markers' liveedit data.
+
+        Returns a list of (editing allowed, draft URL) tuples, in the same
+        order as the references.
+        """
+        ids_by_content_type = defaultdict(set)
+        for ref in references:
+            try:
+                ids_by_content_type[int(ref['content_type_id'])].add(int(ref['object_id']))
+            except (KeyError, TypeError, ValueError):
+                pass
+
+        objects = {}
+        for content_type_id, ids in ids_by_content_type.items():
+            try:
+                model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+            except ContentType.DoesNotExist:
+                continue
+            if model_class is None:
+                continue
+            queryset = model_class._default_manager.filter(pk__in=ids)
+            if hasattr(queryset, 'prefetch_workflow_states'):
+                # Wagtail >= 5.0: checking page permissions looks up the
+                # page's current workflow task, so fetch them all at once
+                queryset = queryset.prefetch_workflow_states()
+            for obj in queryset:
+                objects[(content_type_id, obj.pk)] = obj
+
+        verdicts = []
+        for ref in references:
+            try:
+                obj = objects.get((int(ref['content_type_id']), int(ref['object_id'])))
+            except (KeyError, TypeError, ValueError):
+                obj = None
+
+            if obj is None:
+                verdicts.append((False, None))
+            else:
+                verdicts.append(self._get_verdict(
+                    obj,
+                    ref.get('revision_id'),
+                    bool(ref.get('preview')),
+                ))
+        return verdicts
+
+    def _get_verdict(self, obj, revision_id, is_preview):
+        key = (type(obj), obj.pk, revision_id, is_preview)
+        if key not in self.verdicts:
+            self.verdicts[key] = self._check(obj, revision_id, is_preview)
+        return self.verdicts[key]
+
+    def _check(self, obj, revision_id, is_preview):
+        request = self.request
+
+        if isinstance(obj, Page):
+            perms = obj.permissions_for_user(request.user)
+            if not perms.can_edit():
+                return False, None
+
+            if obj.has_unpublished_changes:
+                # There is a new unpublished version of this page, are we looking at it?
+                latest_rev_id = getattr(obj, 'latest_revision_id', None)
+                if latest_rev_id is None:
+                    latest_rev_id = obj.get_latest_revision().id
+
+                if revision_id!=latest_rev_id:
+                    # We're not, so don't allow live editing, but send a link to the latest revision.
+                    return False, get_page_draft_url(obj, latest_rev_id)
+
+                if is_preview:
+                    # We're viewing an unsaved preview, don't allow editing
+                    return False, None
+
+            elif getattr(request, 'is_dummy', False):
+                # We are in preview mode, without a unpublished revision, don't allow editing
+                return False, None
+
+        elif not request.user.has_perm("%s.change" % obj._meta.app_label):
+            return False, None
+
+        elif getattr(obj, 'has_unpublished_changes', False):
+            # A snippet (or other model) with a draft, which is what would be
+            # edited - are we looking at it?
+            if revision_id is None or revision_id != getattr(obj, 'latest_revision_id', None):
+                # We're not, so don't allow live editing. There's no link to
+                # the draft, since the notice shown with it is about the page
+                # (which a snippet is only part of) having a draft.
+                return False, None
+
+            if is_preview:
+                return False, None
+
+        return True, None
+
+
+def get_page_draft_url(page, revision_id):
+    """
+    Return the URL of the admin's view of a revision of a page, where the draft
+    can be live edited.
+    """
+    return reverse('wagtailadmin_pages:revisions_view', args=(page.id, revision_id))
+
+
+def get_permission_resolver(request):
+    """
+    Return the EditPermissionResolver for the request, creating it if
+    necessary, so that verdicts are shared by everything rendered for the
+    request.
+    """
+    try:
+        return request._live_edit_permissions
+    except AttributeError:
+        resolver = request._live_edit_permissions = EditPermissionResolver(request)
+        return resolver
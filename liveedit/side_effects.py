@@ -0,0 +1,253 @@
+"""
+Saving a page or snippet runs the search index update and, with the frontend
+cache app installed, the CDN purge for it there and then, and publishing a
+page saves it more than once, so each is done several times per live edit.
+
+While saving live edits (see `defer_side_effects`), these are collected per
+object instead, and handed to a backend once the transaction commits. The
+default `ImmediateBackend` then runs each once, using Wagtail's own receivers,
+so that the search index update still goes through Wagtail's task queue where
+it has one.
+
+`LIVEEDIT_SIDE_EFFECTS_BACKEND` can be set to the path of another class with
+an `enqueue` method like `ImmediateBackend`'s (eg, one queueing a task which
+calls `run_side_effects`), or to None to run them on save as normal. The
+`ThreadBackend` also merges the side effects of a burst of edits, but only
+within a process, and loses any that are waiting when the process exits.
+"""
+
+from django.apps import apps
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from contextlib import contextmanager
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+_lock = threading.Lock()
+_installed = False
+_backends = {}
+
+
+def index_object(obj):
+    from wagtail.search.signal_handlers import post_save_signal_handler
+    post_save_signal_handler(sender=type(obj), instance=obj)
+
+def purge_object(obj):
+    from wagtail.contrib.frontend_cache.signal_handlers import page_published_signal_handler
+    page_published_signal_handler(sender=type(obj), instance=obj)
+
+# What to run for each kind of side effect, ie the original receivers
+EFFECTS = {
+    'index': index_object,
+    'purge': purge_object,
+}
+
+
+def get_deferrable_receivers():
+    """
+    Return the signal receivers whose work can be deferred, as a list of
+    (signal, receiver, effect) tuples.
+    """
+    receivers = []
+
+    try:
+        from wagtail.search.signal_handlers import post_save_signal_handler
+    except ImportError:
+        pass
+    else:
+        receivers.append((post_save, post_save_signal_handler, 'index'))
+
+    try:
+        from wagtail.contrib.frontend_cache.signal_handlers import page_published_signal_handler
+        try:
+            from wagtail.signals import page_published
+        except ImportError:
+            # Wagtail <3
+            from wagtail.core.signals import page_published
+    except ImportError:
+        pass
+    else:
+        receivers.append((page_published, page_published_signal_handler, 'purge'))
+
+    return receivers
+
+
+def make_deferring_receiver(original, effect):
+    def deferring_receiver(sender, instance, **kwargs):
+        pending = getattr(_state, 'pending', None)
+        if pending is None:
+            return original(sender=sender, instance=instance, **kwargs)
+
+        key = (instance._meta.app_label, instance._meta.model_name, str(instance.pk))
+        pending.setdefault(key, set()).add(effect)
+
+    return deferring_receiver
+
+
+def install_receivers():
+    """
+    Swap the deferrable receivers for ones which collect their side effects
+    while live edits are being saved, and otherwise run them as before.
+
+    This is done on first use, by which time every app has connected its
+    receivers.
+    """
+    global _installed
+
+    with _lock:
+        if _installed:
+            return
+
+        for signal, original, effect in get_deferrable_receivers():
+            deferring_receiver = make_deferring_receiver(original, effect)
+            for model in apps.get_models():
+                if signal.disconnect(original, sender=model):
+                    signal.connect(deferring_receiver, sender=model, weak=False)
+
+        _installed = True
+
+
+def get_backend():
+    """
+    Return the backend instance given by the `LIVEEDIT_SIDE_EFFECTS_BACKEND`
+    setting, or None if side effects shouldn't be deferred.
+    """
+    path = getattr(settings, 'LIVEEDIT_SIDE_EFFECTS_BACKEND', 'liveedit.side_effects.ImmediateBackend')
+    if not path:
+        return None
+
+    with _lock:
+        if path not in _backends:
+            _backends[path] = import_string(path)()
+        return _backends[path]
+
+@receiver(setting_changed)
+def clear_backends(**kwargs):
+    if kwargs['setting'].startswith('LIVEEDIT_SIDE_EFFECTS'):
+        _backends.clear()
+
+
+@contextmanager
+def defer_side_effects():
+    """
+    Collect the side effects of saves made within this block, and enqueue them
+    with the backend (at most once for each object) when the transaction
+    commits.
+    """
+    backend = get_backend()
+    if backend is None or getattr(_state, 'pending', None) is not None:
+        # Not deferring, or already collecting for an outer block
+        yield
+        return
+
+    install_receivers()
+
+    pending = _state.pending = {}
+    try:
+        yield
+    finally:
+        _state.pending = None
+        for (app_label, model_name, pk), effects in pending.items():
+            transaction.on_commit(functools.partial(
+                backend.enqueue, app_label, model_name, pk, frozenset(effects)
+            ))
+
+
+def run_side_effects(app_label, model_name, pk, effects):
+    """
+    Run the given side effects for an object, if it still exists. Backends
+    (and the tasks they queue) call this to do the actual work.
+    """
+    model = apps.get_model(app_label, model_name)
+    obj = model._default_manager.filter(pk=pk).first()
+    if obj is None:
+        return
+
+    for effect in sorted(effects):
+        EFFECTS[effect](obj)
+
+
+class ImmediateBackend:
+    """
+    Run side effects as soon as the transaction commits, once per object for
+    each save of live edits. This is the default.
+    """
+
+    def enqueue(self, app_label, model_name, pk, effects):
+        run_side_effects(app_label, model_name, pk, effects)
+
+
+class ThreadBackend:
+    """
+    Run side effects in a background thread, once the object hasn't been saved
+    again for `LIVEEDIT_SIDE_EFFECTS_DELAY` seconds (2 by default), merging the
+    side effects of all the saves in between.
+
+    Bursts are only merged within a process, and anything still waiting when
+    the process exits is lost, so this must be turned on explicitly, by setting
+    `LIVEEDIT_SIDE_EFFECTS_BACKEND` to `'liveedit.side_effects.ThreadBackend'`.
+    """
+
+    def __init__(self, delay=None):
+        if delay is None:
+            delay = getattr(settings, 'LIVEEDIT_SIDE_EFFECTS_DELAY', 2)
+        self.delay = delay
+        # (app_label, model_name, pk) -> (due time, set of effects)
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def enqueue(self, app_label, model_name, pk, effects):
+        key = (app_label, model_name, pk)
+        with self.condition:
+            _, queued = self.pending.get(key, (None, frozenset()))
+            self.pending[key] = (time.monotonic() + self.delay, queued | effects)
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.work, name='liveedit-side-effects', daemon=True
+                )
+                self.thread.start()
+            self.condition.notify()
+
+    def next_due(self):
+        """
+        Wait for an object's side effects to be due, then remove and return
+        them.
+        """
+        with self.condition:
+            while True:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+
+                key, (due, effects) = min(self.pending.items(), key=lambda item: item[1][0])
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    del self.pending[key]
+                    return key, effects
+                self.condition.wait(remaining)
+
+    def run(self, app_label, model_name, pk, effects):
+        run_side_effects(app_label, model_name, pk, effects)
+
+    def work(self):
+        while True:
+            key, effects = self.next_due()
+            try:
+                self.run(*key, effects)
+            except Exception:
+                logger.exception("Failed to run %s for %s.%s %s", ", ".join(sorted(effects)), *key)
+            finally:
+                # This thread's connections aren't closed by any request
+                connections.close_all()
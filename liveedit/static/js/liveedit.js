@@ -1,18 +1,248 @@
 (function() {
-    var liveedit_context = {};
+    var liveedit_context = {
+        // latest known version of each StreamField's content, by liveedit_field_key
+        versions: {}
+    };
+    var liveedit_script = document.currentScript;
+    // for the requests which need one, and the toolbar's initial state (in
+    // deferred mode, these come from the editable endpoint instead)
+    liveedit_context.csrf_token = liveedit_script && liveedit_script.getAttribute('data-csrf-token');
+    liveedit_context.draft_mode = !!(liveedit_script && liveedit_script.getAttribute('data-draft-mode'));
 
     function liveedit_close_panel() {
         if(liveedit_context.edit_panel) {
+            // hide the panel, but keep it for editing the next block
             var panel = liveedit_context.edit_panel;
             panel.style.bottom = '-60vh';
             liveedit_context.edit_panel = null;
             setTimeout(function() {
-                panel.remove();
+                if(liveedit_context.edit_panel!==panel) panel.style.visibility = 'hidden';
             }, 500);
         }
     }
 
-    document.querySelectorAll('*[data-liveedit]').forEach(function(el) {
+    function liveedit_panel() {
+        // Return the edit panel, creating it (hidden) if it doesn't exist yet.
+        // The same panel, and its iframe, is used for every edit, so that the
+        // admin scripts and stylesheets are only loaded once.
+        if(liveedit_context.panel) return liveedit_context.panel;
+
+        var con = document.createElement('div');
+        con.classList.add('liveedit-panel');
+        con.style.visibility = 'hidden';
+
+        var topbar = document.createElement('div');
+        topbar.classList.add('liveedit-topbar');
+
+        var title = document.createElement('div');
+        title.classList.add('liveedit-title');
+        topbar.appendChild(title);
+
+        var close = document.createElement('div');
+        close.style.cursor = "pointer";
+        close.innerHTML = '<svg id="icon-cross" viewBox="0 0 16 16"><path d="M13.313 11.313c0 0.219-0.094 0.438-0.25 0.594l-1.219 1.219c-0.156 0.156-0.375 0.25-0.625 0.25-0.219 0-0.438-0.094-0.594-0.25l-2.625-2.625-2.625 2.625c-0.156 0.156-0.375 0.25-0.594 0.25-0.25 0-0.469-0.094-0.625-0.25l-1.219-1.219c-0.156-0.156-0.25-0.375-0.25-0.594 0-0.25 0.094-0.438 0.25-0.625l2.625-2.625-2.625-2.625c-0.156-0.156-0.25-0.375-0.25-0.594 0-0.25 0.094-0.438 0.25-0.625l1.219-1.188c0.156-0.188 0.375-0.25 0.625-0.25 0.219 0 0.438 0.063 0.594 0.25l2.625 2.625 2.625-2.625c0.156-0.188 0.375-0.25 0.594-0.25 0.25 0 0.469 0.063 0.625 0.25l1.219 1.188c0.156 0.188 0.25 0.375 0.25 0.625 0 0.219-0.094 0.438-0.25 0.594l-2.625 2.625 2.625 2.625c0.156 0.188 0.25 0.375 0.25 0.625z"></path></svg>';
+        close.style.float = 'right';
+        close.addEventListener('click', liveedit_close_panel);
+        topbar.appendChild(close);
+        con.appendChild(topbar);
+
+        var panel = liveedit_context.panel = {
+            container: con,
+            title: title,
+            iframe: document.createElement('iframe'),
+            loading: true,
+            pending: null
+        };
+        panel.iframe.addEventListener('load', function() {
+            panel.loading = false;
+            if(panel.pending) liveedit_panel_load(panel.pending);
+        });
+        panel.iframe.setAttribute('src', '/__liveedit__/panel/');
+        con.appendChild(panel.iframe);
+
+        document.body.appendChild(con);
+        return panel;
+    }
+
+    function liveedit_panel_load(url) {
+        // Show the form at the given URL in the edit panel
+        var panel = liveedit_panel();
+        if(panel.loading) {
+            // wait for the panel to finish loading
+            panel.pending = url;
+            return;
+        }
+        panel.pending = null;
+
+        var win = panel.iframe.contentWindow;
+        if(win && win.liveedit_load_form) {
+            win.liveedit_load_form(url);
+        } else {
+            // the iframe isn't showing a panel anymore, so load the whole form
+            panel.loading = true;
+            panel.iframe.setAttribute('src', url);
+        }
+    }
+
+    function liveedit_block_element(id) {
+        // blocks are decorated lazily, so look for the block itself rather
+        // than its bar
+        var els = document.querySelectorAll('*[data-liveedit]');
+        for(var i=0; i<els.length; i++) {
+            if(JSON.parse(els[i].getAttribute('data-liveedit')).id==id) return els[i];
+        }
+        return null;
+    }
+
+    function liveedit_sibling_elements(els) {
+        // Blocks may be wrapped by other elements in the page template, so
+        // find the ancestors of each that are siblings of one another.
+        var parent = els[0].parentElement;
+        while(parent && !els.every(function(el) { return parent.contains(el); })) {
+            parent = parent.parentElement;
+        }
+        if(!parent) return null;
+
+        return els.map(function(el) {
+            while(el.parentElement != parent) el = el.parentElement;
+            return el;
+        });
+    }
+
+    function liveedit_reorder(ids) {
+        // Rearrange the DOM elements of the given (adjacent) blocks to match
+        // the order of the ids. Returns false if they can't be rearranged.
+        var els = ids.map(liveedit_block_element);
+        if(els.indexOf(null) != -1) return false;
+
+        els = liveedit_sibling_elements(els);
+        if(!els) return false;
+        var parent = els[0].parentElement;
+
+        // move them all to just before whichever is currently first
+        var first = els.reduce(function(a, b) {
+            return (a.compareDocumentPosition(b) & Node.DOCUMENT_POSITION_PRECEDING) ? b : a;
+        });
+        var marker = document.createComment('');
+        parent.insertBefore(marker, first);
+        els.forEach(function(el) {
+            parent.insertBefore(el, marker);
+        });
+        marker.remove();
+        return true;
+    }
+
+    function liveedit_field_key(data) {
+        return [data.content_type_id, data.object_id, data.object_field].join(':');
+    }
+
+    function liveedit_version(data) {
+        // the version of the StreamField's content that changes are based on
+        return liveedit_context.versions[liveedit_field_key(data)] || data.version || '';
+    }
+
+    function liveedit_parent_block(el) {
+        var parent = el.parentElement;
+        while(parent && !parent.hasAttribute('data-liveedit')) parent = parent.parentElement;
+        return parent;
+    }
+
+    function liveedit_sibling_blocks(el, data) {
+        // The blocks from the same StreamField which are nested within the
+        // same block (or none) as the given one.
+        var key = liveedit_field_key(data), parent = liveedit_parent_block(el);
+        return Array.prototype.filter.call(document.querySelectorAll('*[data-liveedit]'), function(other) {
+            var other_data = JSON.parse(other.getAttribute('data-liveedit'));
+            return other_data.id && liveedit_field_key(other_data)==key && liveedit_parent_block(other)===parent;
+        });
+    }
+
+    function liveedit_block_ids(els) {
+        // the ids of the blocks, in document order
+        return els.slice().sort(function(a, b) {
+            return (a.compareDocumentPosition(b) & Node.DOCUMENT_POSITION_FOLLOWING) ? -1 : 1;
+        }).map(function(el) {
+            return JSON.parse(el.getAttribute('data-liveedit')).id;
+        });
+    }
+
+    function liveedit_drag_start(el, data, ev) {
+        var group = liveedit_sibling_blocks(el, data);
+        var wrappers = liveedit_sibling_elements(group);
+        if(!wrappers || wrappers.some(function(w, i) { return wrappers.indexOf(w) != i; })) {
+            // the blocks can't be rearranged independently of one another
+            ev.preventDefault();
+            return;
+        }
+
+        liveedit_context.drag = {
+            el: el,
+            data: data,
+            group: group,
+            wrappers: wrappers,
+            order: liveedit_block_ids(group)
+        };
+        ev.dataTransfer.effectAllowed = 'move';
+        ev.dataTransfer.setData('text/plain', data.id);
+        el.classList.add('liveedit-dragging');
+    }
+
+    function liveedit_drag_over(el, ev) {
+        var drag = liveedit_context.drag;
+        if(!drag) return;
+        var i = drag.group.indexOf(el);
+        if(i == -1) return; // not a sibling, so leave it to an enclosing block
+
+        ev.preventDefault();
+        ev.stopPropagation();
+        ev.dataTransfer.dropEffect = 'move';
+        if(el == drag.el) return;
+
+        // move the dragged block before or after this one straight away, the
+        // new order is saved when the drag ends
+        var target = drag.wrappers[i];
+        var moving = drag.wrappers[drag.group.indexOf(drag.el)];
+        var rect = target.getBoundingClientRect();
+        var after = ev.clientY > rect.top + rect.height / 2;
+        target.parentElement.insertBefore(moving, after ? target.nextSibling : target);
+    }
+
+    function liveedit_drag_end() {
+        var drag = liveedit_context.drag;
+        liveedit_context.drag = null;
+        if(!drag) return;
+        drag.el.classList.remove('liveedit-dragging');
+
+        var ids = liveedit_block_ids(drag.group);
+        if(ids.join() == drag.order.join()) return;
+
+        var body = new FormData();
+        ['content_type_id', 'object_id', 'object_field'].forEach(function(k) {
+            body.append(k, drag.data[k]);
+        });
+        body.append('version', liveedit_version(drag.data));
+        body.append('operations', JSON.stringify([{action: 'reorder', ids: ids}]));
+
+        fetch('/__liveedit__/batch/', {
+            method: 'POST',
+            body: body,
+            headers: {'X-CSRFToken': liveedit_context.csrf_token || ''},
+            credentials: 'same-origin'
+        }).then(function(response) {
+            if(!response.ok) throw new Error(response.statusText);
+            return response.json();
+        }).then(function(result) {
+            liveedit_context.versions[liveedit_field_key(drag.data)] = result.version;
+            liveedit_note_draft(result.draft);
+        }).catch(function() {
+            // the new order couldn't be saved (eg, someone else has changed
+            // the blocks), so show the blocks as they are saved
+            liveedit_reload(drag.data.id);
+        });
+    }
+
+    function liveedit_decorate(el) {
+        if(el.hasAttribute('data-liveedit-active')) return;
         var data = JSON.parse(el.getAttribute('data-liveedit'));
 
         var bar = document.createElement('div');
@@ -20,11 +250,6 @@
         bar.setAttribute('id', 'le-' + data.id);
 
         function submitAction(action, btn) {
-            var form = document.createElement('form');
-            form.style.display = 'none';
-            form.setAttribute('method', 'post');
-            form.setAttribute('action', '/__liveedit__/action/');
-
             data['action'] = action;
             data['redirect_url'] = window.location.pathname + window.location.search + '#le-' + data.id;
             if(btn) {
@@ -32,18 +257,62 @@
                 data['redirect_url'] += '_y' + parseInt(btn.getBoundingClientRect().top);
             }
 
+            var body = new FormData();
             Object.keys(data).forEach(function(k) {
-                var inp = document.createElement('input');
-                inp.setAttribute('type', 'hidden');
-                inp.setAttribute('name', k);
-                inp.setAttribute('value', data[k]);
-                form.appendChild(inp);
+                body.append(k, data[k]);
             });
+            body.set('version', liveedit_version(data));
+            body.append('format', 'json');
 
-            document.body.appendChild(form);
-            form.submit();
+            fetch('/__liveedit__/action/', {
+                method: 'POST',
+                body: body,
+                headers: {'X-CSRFToken': liveedit_context.csrf_token || ''},
+                credentials: 'same-origin'
+            }).then(function(response) {
+                if(response.status==409) {
+                    // someone else has changed the blocks, so show their changes
+                    return liveedit_reload(data.id);
+                }
+                if(!response.ok) throw new Error(response.statusText);
+                return response.json();
+            }).then(function(result) {
+                if(!result || !result.moved) return;
+                liveedit_context.versions[liveedit_field_key(data)] = result.version;
+                liveedit_note_draft(result.draft);
+
+                // keep the moved block at the same position in the viewport
+                var top = el.getBoundingClientRect().top;
+                if(liveedit_reorder(result.affected)) {
+                    window.scrollBy(0, el.getBoundingClientRect().top - top);
+                } else {
+                    // couldn't rearrange the blocks in place, so reload instead
+                    liveedit_reload(data.id);
+                }
+            }).catch(function() {
+                window.location.reload();
+            });
         }
 
+        if(data.id) {
+            // drag the bar to move the block among its siblings
+            bar.setAttribute('draggable', 'true');
+            bar.addEventListener('dragstart', function(ev) {
+                ev.stopPropagation();
+                liveedit_drag_start(el, data, ev);
+            });
+            bar.addEventListener('dragend', function(ev) {
+                ev.stopPropagation();
+                liveedit_drag_end();
+            });
+        }
+        el.addEventListener('dragover', function(ev) {
+            liveedit_drag_over(el, ev);
+        });
+        el.addEventListener('drop', function(ev) {
+            if(liveedit_context.drag) ev.preventDefault();
+        });
+
         if(data.id) {
             var btn = document.createElement('button');
             var icon = document.createElement('div');
@@ -71,35 +340,16 @@
         function loadEditPanel(url, panel_title) {
             if(liveedit_context.edit_panel) return; //panel already open
 
-            var con = document.createElement('div');
-            con.classList.add('liveedit-panel');
+            var panel = liveedit_panel();
+            var con = panel.container;
             liveedit_context.edit_panel = con;
+            panel.title.textContent = panel_title;
+            liveedit_panel_load(url);
+
+            con.style.visibility = 'visible';
             setTimeout(function() {
                 con.style.bottom = 0;
             }, 50);
-
-            var topbar = document.createElement('div');
-            topbar.classList.add('liveedit-topbar');
-
-            var title = document.createElement('div');
-            
-            title.appendChild(document.createTextNode(panel_title));
-            title.classList.add('liveedit-title');
-            topbar.appendChild(title);
-
-            var close = document.createElement('div');
-            close.style.cursor = "pointer";
-            close.innerHTML = '<svg id="icon-cross" viewBox="0 0 16 16"><path d="M13.313 11.313c0 0.219-0.094 0.438-0.25 0.594l-1.219 1.219c-0.156 0.156-0.375 0.25-0.625 0.25-0.219 0-0.438-0.094-0.594-0.25l-2.625-2.625-2.625 2.625c-0.156 0.156-0.375 0.25-0.594 0.25-0.25 0-0.469-0.094-0.625-0.25l-1.219-1.219c-0.156-0.156-0.25-0.375-0.25-0.594 0-0.25 0.094-0.438 0.25-0.625l2.625-2.625-2.625-2.625c-0.156-0.156-0.25-0.375-0.25-0.594 0-0.25 0.094-0.438 0.25-0.625l1.219-1.188c0.156-0.188 0.375-0.25 0.625-0.25 0.219 0 0.438 0.063 0.594 0.25l2.625 2.625 2.625-2.625c0.156-0.188 0.375-0.25 0.594-0.25 0.25 0 0.469 0.063 0.625 0.25l1.219 1.188c0.156 0.188 0.25 0.375 0.25 0.625 0 0.219-0.094 0.438-0.25 0.594l-2.625 2.625 2.625 2.625c0.156 0.188 0.25 0.375 0.25 0.625z"></path></svg>';
-            close.style.float = 'right';
-            close.addEventListener('click', liveedit_close_panel);
-            topbar.appendChild(close);
-            con.appendChild(topbar);
-
-            var iframe = document.createElement('iframe');
-            iframe.setAttribute('src', url);
-            con.appendChild(iframe);
-
-            document.body.appendChild(con);
         }
 
         if(data.id) {
@@ -138,57 +388,326 @@
         el.insertAdjacentElement('afterbegin', bar);
         el.setAttribute('data-liveedit-active', true);
         document.documentElement.setAttribute('data-liveedit-active', true);
-    });
+        liveedit_prewarm_panel();
+        liveedit_toolbar();
+    }
+
+    function liveedit_decorate_lazily(el) {
+        // Decorate blocks as they're about to be scrolled into view, rather
+        // than all of them up front.
+        if(!('IntersectionObserver' in window)) return liveedit_decorate(el);
+
+        if(!liveedit_context.observer) {
+            liveedit_context.observer = new IntersectionObserver(function(entries) {
+                entries.forEach(function(entry) {
+                    if(!entry.isIntersecting) return;
+                    liveedit_context.observer.unobserve(entry.target);
+                    liveedit_decorate(entry.target);
+                });
+            }, {rootMargin: '200px'});
+        }
+        liveedit_context.observer.observe(el);
+    }
+
+    function liveedit_prewarm_panel() {
+        // Once there's something to edit, create the (hidden) edit panel
+        // while the browser is idle, so that its admin scripts and
+        // stylesheets are loaded by the time it is opened.
+        if(liveedit_context.prewarm) return;
+        liveedit_context.prewarm = true;
+
+        (window.requestIdleCallback || function(cb) { setTimeout(cb, 2000); })(liveedit_panel);
+    }
+
+    function liveedit_activate(el) {
+        // in deferred mode, make a marked block editable
+        if(!el.hasAttribute('data-liveedit')) {
+            el.setAttribute('data-liveedit', el.getAttribute('data-liveedit-marker'));
+        }
+        liveedit_decorate_lazily(el);
+    }
+
+    function liveedit_toolbar() {
+        // Add the toolbar, for turning draft mode (where edits are saved into
+        // a draft) on and off for the session, and publishing the drafts.
+        if(liveedit_context.toolbar) return;
+        var toolbar = liveedit_context.toolbar = document.createElement('div');
+        toolbar.classList.add('liveedit-bar', 'liveedit-toolbar');
+
+        var toggle = document.createElement('button');
+        var publish = document.createElement('button');
+        publish.appendChild(document.createTextNode('Publish changes'));
+
+        function send(url, body) {
+            return fetch(url, {
+                method: 'POST',
+                body: body,
+                headers: {'X-CSRFToken': liveedit_context.csrf_token || ''},
+                credentials: 'same-origin'
+            }).then(function(response) {
+                if(!response.ok) {
+                    return response.text().then(function(text) {
+                        throw new Error(response.status==409 ? text : response.statusText);
+                    });
+                }
+                return response.json();
+            });
+        }
+
+        function update(draft_mode) {
+            liveedit_context.draft_mode = draft_mode;
+            toggle.textContent = 'Drafts ' + (draft_mode ? 'on' : 'off');
+            toggle.setAttribute('aria-pressed', draft_mode ? 'true' : 'false');
+            publish.style.display = draft_mode ? '' : 'none';
+        }
+
+        toggle.addEventListener('click', function(ev) {
+            ev.preventDefault();
+            var body = new FormData();
+            body.append('draft_mode', liveedit_context.draft_mode ? '0' : '1');
+            send('/__liveedit__/draft-mode/', body).then(function(result) {
+                update(result.draft_mode);
+            });
+        });
+
+        publish.addEventListener('click', function(ev) {
+            ev.preventDefault();
+            var drafts = liveedit_drafts();
+            var objects = Object.keys(drafts).map(function(key) { return drafts[key]; });
+            if(!objects.length) {
+                alert("There are no changes to publish.");
+                return;
+            }
+
+            var body = new FormData();
+            body.append('objects', JSON.stringify(objects));
+            publish.disabled = true;
+            send('/__liveedit__/publish/', body).then(function() {
+                liveedit_save_drafts({});
+                window.location.reload();
+            }).catch(function(e) {
+                publish.disabled = false;
+                alert("The changes couldn't be published. " + e.message);
+            });
+        });
+
+        toolbar.appendChild(toggle);
+        toolbar.appendChild(publish);
+        update(liveedit_context.draft_mode);
+        document.body.appendChild(toolbar);
+    }
+
+    function liveedit_drafts() {
+        // The drafts that this editor's changes have been saved into in draft
+        // mode, by object, to be published with the toolbar's button. They're
+        // kept for the browser session, since editing often reloads the page.
+        if(!liveedit_context.drafts) {
+            try {
+                liveedit_context.drafts = JSON.parse(window.sessionStorage.getItem('liveedit_drafts')) || {};
+            } catch(e) {
+                liveedit_context.drafts = {};
+            }
+        }
+        return liveedit_context.drafts;
+    }
+
+    function liveedit_save_drafts(drafts) {
+        liveedit_context.drafts = drafts;
+        try {
+            window.sessionStorage.setItem('liveedit_drafts', JSON.stringify(drafts));
+        } catch(e) {
+            // not available, so only remember them until the page is left
+        }
+    }
+
+    function liveedit_note_draft(draft) {
+        // Remember the revision a change was saved into (as described by the
+        // backend's get_saved_draft), so that only that revision is published
+        if(!draft) return;
+        if(draft.url) liveedit_context.draft_url = draft.url;
+        var drafts = liveedit_drafts();
+        drafts[draft.content_type_id + ':' + draft.object_id] = draft;
+        liveedit_save_drafts(drafts);
+    }
+
+    function liveedit_object_key(data) {
+        return [data.content_type_id, data.object_id, data.object_field, data.revision_id, data.preview].join(':');
+    }
+
+    function liveedit_load_deferred(editor_cookie) {
+        // In deferred mode, blocks are only marked, so ask the backend which
+        // of the marked objects are editable by the current user.
+        if(!editor_cookie || !document.cookie.split(/;\s*/).some(function(c) {
+            return c.indexOf(editor_cookie + '=')===0;
+        })) {
+            // not an editor (see EditorCookieMiddleware), so don't bother asking
+            return;
+        }
+
+        var markers = document.querySelectorAll('*[data-liveedit-marker]');
+        var objects = [], indexes = {};
+        markers.forEach(function(el) {
+            var data = JSON.parse(el.getAttribute('data-liveedit-marker'));
+            var key = liveedit_object_key(data);
+            if(data.content_type_id && !(key in indexes)) {
+                indexes[key] = objects.length;
+                objects.push({
+                    content_type_id: data.content_type_id,
+                    object_id: data.object_id,
+                    object_field: data.object_field,
+                    revision_id: data.revision_id,
+                    preview: data.preview
+                });
+            }
+        });
+        if(!objects.length) return;
+
+        fetch('/__liveedit__/editable/?objects=' + encodeURIComponent(JSON.stringify(objects)), {
+            credentials: 'same-origin'
+        }).then(function(response) {
+            if(!response.ok) throw new Error(response.statusText);
+            return response.json();
+        }).then(function(result) {
+            liveedit_context.csrf_token = result.csrf_token;
+            liveedit_context.draft_mode = result.draft_mode;
+            markers.forEach(function(el) {
+                var state = result.objects[indexes[liveedit_object_key(JSON.parse(el.getAttribute('data-liveedit-marker')))]];
+                if(state && state.editable) liveedit_activate(el);
+            });
+            result.objects.forEach(function(state) {
+                if(state.draft_url) liveedit_draft_notice(state.draft_url);
+            });
+            liveedit_jump();
+        }).catch(function() {
+            // not logged in, or not an editor
+        });
+    }
+
+    function liveedit_reload(jump_to_id) {
+        if(liveedit_context.edit_panel) {
+            liveedit_context.edit_panel.style.bottom = '-60vh';
+        }
+        // once a page's changes are saved into a draft, its blocks can only
+        // be edited when viewing the draft, so go there instead
+        var path = window.location.pathname + window.location.search;
+        var url = liveedit_context.draft_url || path;
+
+        var el = jump_to_id && liveedit_block_element(jump_to_id);
+        var hash = el ? '#le-' + jump_to_id + '_y' + parseInt(el.getBoundingClientRect().top) : '';
+        if(url != path) {
+            window.location.assign(url + hash);
+            return;
+        }
+        if(hash) {
+            // append editing id and distance of top of viewport
+            // (but won't reload due to path staying the same)
+            window.location.assign(path + hash);
+        }
+        window.location.reload();
+    }
+
+    function liveedit_rerender(id) {
+        // Replace just the given block with a freshly rendered copy, falling
+        // back to reloading the whole page if that isn't possible.
+        var el = liveedit_block_element(id);
+        if(!el) return liveedit_reload(id);
+
+        var data = JSON.parse(el.getAttribute('data-liveedit'));
+        if(data.inline) {
+            // rendered directly by the page template, rather than the block's
+            return liveedit_reload(id);
+        }
+
+        fetch('/__liveedit__/render-block/?id=' + encodeURIComponent(data.id) +
+            '&content_type_id=' + encodeURIComponent(data.content_type_id) +
+            '&object_id=' + encodeURIComponent(data.object_id) +
+            '&object_field=' + encodeURIComponent(data.object_field), {
+            credentials: 'same-origin'
+        }).then(function(response) {
+            if(!response.ok) throw new Error(response.statusText);
+            return response.json();
+        }).then(function(result) {
+            var fragment = document.createElement('template');
+            fragment.innerHTML = result.html;
+            var nodes = Array.prototype.filter.call(fragment.content.childNodes, function(n) {
+                return n.nodeType == Node.ELEMENT_NODE || (n.nodeType == Node.TEXT_NODE && n.textContent.trim());
+            });
+
+            // we can only tell which part of the page to replace if the block
+            // consists of the single element carrying its attributes
+            var attr = el.hasAttribute('data-liveedit-marker') ? 'data-liveedit-marker' : 'data-liveedit';
+            if(result.reload || nodes.length != 1 || !nodes[0].hasAttribute || !nodes[0].hasAttribute(attr)) {
+                return liveedit_reload(id);
+            }
+
+            if(result.version) {
+                liveedit_context.versions[liveedit_field_key(data)] = result.version;
+            }
+            el.replaceWith(nodes[0]);
+            liveedit_activate(nodes[0]);
+            nodes[0].querySelectorAll('*[' + attr + ']').forEach(liveedit_activate);
+            liveedit_close_panel();
+        }).catch(function() {
+            liveedit_reload(id);
+        });
+    }
 
     window.addEventListener("message", function(event) {
         // is this sufficient?
         if(event.origin != window.origin) return;
+        if(event.data) liveedit_note_draft(event.data.draft);
 
         if(event.data && event.data.action=="reload") {
-            if(liveedit_context.edit_panel) {
-                liveedit_context.edit_panel.style.bottom = '-60vh';
-            }
-            var lebar = document.getElementById('le-' + event.data.jump_to_id);
-            if(event.data.jump_to_id && lebar && lebar.parentElement) {
-                // append editing id and distance of top of viewport
-                // (but won't reload due to path staying the same)
-                window.location.assign(window.location.pathname + window.location.search + '#le-' + event.data.jump_to_id + '_y' + parseInt(lebar.parentElement.getBoundingClientRect().top));
-            }
-            window.location.reload();
+            liveedit_reload(event.data.jump_to_id);
+        } else if(event.data && event.data.action=="rerender") {
+            liveedit_rerender(event.data.id);
         } else if(event.data && event.data.action=="close_panel") {
             liveedit_close_panel();
         }
 
     }, false);
 
-    if(window._live_edit_draft_url) {
+    function liveedit_draft_notice(draft_url) {
+        if(document.querySelector('.liveedit-notice')) return;
+
         var notice = document.createElement('div');
         notice.classList.add('liveedit-notice');
         notice.appendChild(document.createTextNode("There is an unpublished draft of this page."));
 
         var btn = document.createElement('a');
-        btn.setAttribute('href', window._live_edit_draft_url)
+        btn.setAttribute('href', draft_url)
         btn.appendChild(document.createTextNode("View"));
         notice.appendChild(btn);
 
         document.body.appendChild(notice);
+        liveedit_toolbar();
     }
 
     /* Jump to last-actioned block */
-    if(window.location.hash.indexOf('#le-')===0) {
+    function liveedit_jump() {
+        if(window.location.hash.indexOf('#le-')!==0) return;
+
         var bits = window.location.hash.split(/_/g);
-        var p = document.querySelector(bits[0]);
-        if(p && p.parentElement) {
+        var el = liveedit_block_element(bits[0].substring(4));
+        if(el) {
             var y_offset = 100;
             bits.slice(1).forEach(function(b) {
                 if(b.substring(0, 1)=='y') y_offset = parseInt(b.substring(1));
             });
             // TODO: a reliable way to retrigger this as the page loads
             var do_jump = function() {
-                window.scrollTo(0, document.documentElement.scrollTop + p.parentElement.getBoundingClientRect().top - y_offset);
+                window.scrollTo(0, document.documentElement.scrollTop + el.getBoundingClientRect().top - y_offset);
             };
             do_jump();
             setTimeout(do_jump, 200);
         }
     }
+
+    if(liveedit_script && liveedit_script.getAttribute('data-deferred')) {
+        liveedit_load_deferred(liveedit_script.getAttribute('data-editor-cookie'));
+    } else {
+        document.querySelectorAll('*[data-liveedit]').forEach(liveedit_decorate_lazily);
+        if(window._live_edit_draft_url) liveedit_draft_notice(window._live_edit_draft_url);
+        liveedit_jump();
+    }
 })();
@@ -1,18 +1,21 @@
 from django import template
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.middleware.csrf import get_token
+from django.template.backends.django import Template as DjangoTemplate
+from django.template.loader import get_template
 from django.templatetags.static import static
-from django.urls import reverse
 from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 from django.utils.module_loading import import_string
 
 from wagtail.admin.views.pages.preview import PreviewOnEdit
 
 try:
     # Wagtail >= 5.0
-    from wagtail.models import Page
+    from wagtail.blocks import Block, BoundBlock
 except:
-    from wagtail.core.models import Page
+    from wagtail.core.blocks import Block, BoundBlock
 
 try:
     # Wagtail >= 4.0
@@ -20,6 +23,9 @@ try:
 except:
     from wagtail.core.models import PageRevision
 
+from ..permissions import get_permission_resolver
+from ..utils import get_editor_cookie_settings, get_stream_version, is_draft_mode
+
 import json
 
 if hasattr(PageRevision, "as_object"):
@@ -70,10 +76,38 @@ def is_authenticated(request):
         return True
     return False
 
+def _is_live_editing(request):
+    """
+    Whether liveedit is enabled for this request, and the user is logged in.
+
+    The verdict is recorded on the request, so that for anonymous visitors
+    every block after the first is rendered with no further checks.
+    """
+    if request is None:
+        return False
+    try:
+        return request._live_edit_enabled
+    except AttributeError:
+        enabled = request._live_edit_enabled = bool(
+            is_enabled(request) and is_authenticated(request)
+        )
+        return enabled
+
+def _is_deferred():
+    """
+    Whether liveedit is in deferred mode (the `LIVEEDIT_DEFERRED` setting).
+
+    In deferred mode, pages are rendered identically for every visitor, with
+    blocks carrying only a `data-liveedit-marker` attribute, so that they can
+    be cached and shared. The frontend then asks the `editable` endpoint which
+    of the marked blocks the user may edit.
+    """
+    return getattr(settings, 'LIVEEDIT_DEFERRED', False)
+
 @register.simple_tag(takes_context=True)
 def liveedit_css(context):
     request = context.get('request')
-    if not is_enabled(request) or not is_authenticated(request):
+    if not _is_deferred() and not _is_live_editing(request):
         return ''
     return format_html(
         '<link rel="stylesheet" type="text/css" href="{}">',
@@ -83,42 +117,36 @@ def liveedit_css(context):
 @register.simple_tag(takes_context=True)
 def liveedit_js(context):
     request = context.get('request')
-    if not is_enabled(request) or not is_authenticated(request):
+    if _is_deferred():
+        # Let the frontend skip asking which blocks are editable when the
+        # "editor present" cookie (which deferred mode requires) is absent.
+        return format_html(
+            '<script type="text/javascript" src="{}" defer data-deferred="1" data-editor-cookie="{}"></script>',
+            static('js/liveedit.js'),
+            get_editor_cookie_settings()[0],
+        )
+    if not _is_live_editing(request):
         return ''
     return format_html(
-        '<script type="text/javascript" src="{}"></script>',
-        static('js/liveedit.js')
+        '<script type="text/javascript" src="{}" defer data-csrf-token="{}" data-draft-mode="{}"></script>',
+        static('js/liveedit.js'),
+        get_token(request),
+        '1' if is_draft_mode(request) else '',
     )
 
+def _draft_url_script(draft_url):
+    return format_html("<script>window._live_edit_draft_url='{}';</script>", draft_url)
+
 def _is_editing_allowed(object, request):
-    if isinstance(object, Page):
-        perms = object.permissions_for_user(request.user)
-        if not perms.can_edit():
-            return False, None
-
-        if object.has_unpublished_changes:
-            # There is a new unpublished version of this page, are we looking at it?
-            cur_rev_id = getattr(object, '_live_edit_revision_id', None)
-            latest_rev_id = object.get_latest_revision().id
-
-            if cur_rev_id!=latest_rev_id:
-                # We're not, so don't allow live editing, but send a link to the latest revision.
-                return False, format_html("<script>window._live_edit_draft_url='{}';</script>",
-                    reverse('wagtailadmin_pages:revisions_view', args=(object.id, latest_rev_id))
-                )
-
-            if getattr(object, '_live_edit_is_preview', False):
-                # We're viewing an unsaved preview, don't allow editing
-                return False, None
-
-        elif getattr(request, 'is_dummy', False):
-            # We are in preview mode, without a unpublished revision, don't allow editing
-            return False, None
-
-    elif not request.user.has_perm("%s.change" % object._meta.app_label):
-        return False, None
-    
-    return True, None
+    """
+    Return a tuple of (whether the request's user may live edit the object,
+    the URL of the latest draft if editing isn't allowed because the object
+    isn't the latest draft).
+
+    The verdict is memoized for the request, since it is needed for every
+    block rendered from the object's StreamFields.
+    """
+    return get_permission_resolver(request).is_editing_allowed(object)
 
 @register.simple_tag(takes_context=True)
 def liveedit_attributes(context, block=None, object=None, field=None):
@@ -136,29 +164,102 @@ def liveedit_attributes(context, block=None, object=None, field=None):
     }
 
     if block and object and field:
-        request = context.get('request')
-        if not request:
-            return ''
-        
-        editing_allowed, _ = _is_editing_allowed(object, request)
-        if not editing_allowed:
-            return ''
+        if not _is_deferred():
+            request = context.get('request')
+            if not request:
+                return ''
+
+            editing_allowed, _ = _is_editing_allowed(object, request)
+            if not editing_allowed:
+                return ''
 
         data.update({
             'id': block.id,
             'block_type': block.block_type,
-            'content_type_id': ContentType.objects.get_for_model(object).id,
-            'object_id': object.id,
-            'object_field': field
+            **_object_data(object, field),
+            # not rendered by the block's own template, so can't be re-rendered alone
+            'inline': True,
         })
 
     if not data.get('id'):
         return ''
 
-    return format_html('data-liveedit="{}"', 
+    return format_html('{}="{}"',
+        _attribute_name(),
         json.dumps(data)
     )
 
+def _attribute_name():
+    return 'data-liveedit-marker' if _is_deferred() else 'data-liveedit'
+
+def _object_data(object, field):
+    """
+    Return the liveedit data identifying the object and StreamField which
+    blocks come from.
+    """
+    data = {
+        'content_type_id': ContentType.objects.get_for_model(object).id,
+        'object_id': object.id,
+        'object_field': field
+    }
+    version = _field_version(object, field)
+    if version:
+        data['version'] = version
+    if _is_deferred():
+        # Needed by the editable endpoint to check that this is the latest
+        # draft, as _is_editing_allowed does.
+        if getattr(object, '_live_edit_revision_id', None):
+            data['revision_id'] = object._live_edit_revision_id
+        if getattr(object, '_live_edit_is_preview', False):
+            data['preview'] = True
+    return data
+
+def _field_version(object, field):
+    """
+    Return the version of the content of the object's StreamField that blocks
+    are being rendered from, computed once per object.
+    """
+    versions = object.__dict__.setdefault('_live_edit_versions', {})
+    if field not in versions:
+        value = getattr(object, field, None)
+        versions[field] = get_stream_version(value) if hasattr(value, 'raw_data') else None
+    return versions[field]
+
+def _uses_default_rendering(block_def):
+    for name in ('render', 'get_context', 'get_template'):
+        if getattr(type(block_def), name, None) is not getattr(Block, name, None):
+            return False
+    return True
+
+def _render_block(block, context, **extra_context):
+    """
+    Render a block (or other value), like `block.render_as_block`, with the
+    extra variables added to the context.
+
+    `Block.render` needs the context as a dict, which would mean copying the
+    whole template context for every block. Where a bound block uses Wagtail's
+    default rendering with a Django template, a layer carrying just the extra
+    and block variables is pushed onto the existing context instead.
+    """
+    block_def = block.block if isinstance(block, BoundBlock) else None
+    template_name = getattr(getattr(block_def, 'meta', None), 'template', None)
+
+    if template_name and _uses_default_rendering(block_def):
+        template = get_template(template_name)
+        if isinstance(template, DjangoTemplate):
+            # Block templates are always autoescaped, as with Block.render,
+            # whatever the including template's setting
+            autoescape = context.autoescape
+            context.autoescape = True
+            try:
+                with context.push(block_def.get_context(block.value, parent_context=extra_context)):
+                    return mark_safe(template.template.render(context))
+            finally:
+                context.autoescape = autoescape
+
+    with context.push(**extra_context):
+        return block.render_as_block(context.flatten())
+
 @register.simple_tag(takes_context=True)
 def liveedit_include_block(context, block, object=None, field=None):
     """
@@ -171,15 +272,14 @@ def liveedit_include_block(context, block, object=None, field=None):
     The `field` argument is the name of the StreamField on that object, eg 'body'.
     """
 
-    context = context.flatten()
     request = context.get('request')
 
-    def finish():
+    def finish(**extra_context):
         if not block:
             return ''
-        return block.render_as_block(context)
+        return _render_block(block, context, **extra_context)
 
-    if not is_enabled(request) or not is_authenticated(request):
+    if not _is_deferred() and not _is_live_editing(request):
         return finish()
 
     data = {
@@ -191,29 +291,25 @@ def liveedit_include_block(context, block, object=None, field=None):
     }
 
     if object and field:
-        editing_allowed, extra = _is_editing_allowed(object, request)
-        if not editing_allowed:
-            if extra:
-                return finish() + extra
-            return finish()
+        if not _is_deferred():
+            editing_allowed, draft_url = _is_editing_allowed(object, request)
+            if not editing_allowed:
+                if draft_url:
+                    return finish() + _draft_url_script(draft_url)
+                return finish()
 
-        data.update({
-            'content_type_id': ContentType.objects.get_for_model(object).id,
-            'object_id': object.id,
-            'object_field': field
-        })
-
-    context['liveedit_data'] = data
+        data.update(_object_data(object, field))
 
     if not block:
         # No block to render, so insert a placeholder that can be used to
         # insert a new block.
         return format_html(
-            '<div data-liveedit="{}" style="height: 2px"></div>',
-            json.dumps(context['liveedit_data'])
+            '<div {}="{}" style="height: 2px"></div>',
+            _attribute_name(),
+            json.dumps(data)
         )
     
-    return finish()
+    return finish(liveedit_data=data)
 
 @register.simple_tag(takes_context=True)
 def liveedit_insert_new(context, object, field):
@@ -224,3 +320,16 @@ def liveedit_insert_new(context, object, field):
     """
     
     return liveedit_include_block(context, None, object, field)
+
+@register.simple_tag(takes_context=True)
+def liveedit_requires_reload(context):
+    """
+    Declare that a block template depends on more than its own block (eg, on
+    its sibling blocks), so that the whole page is reloaded after the block is
+    edited, rather than just the block being re-rendered.
+    """
+
+    request = context.get('request')
+    if request:
+        request._live_edit_requires_reload = True
+    return ''
@@ -5,5 +5,11 @@ from . import views
 urlpatterns = [
     re_path(r'^action/', views.action_view),
     re_path(r'^append-block/', views.append_block_view),
+    re_path(r'^batch/', views.batch_view),
+    re_path(r'^draft-mode/', views.draft_mode_view),
     re_path(r'^edit-block/', views.edit_block_view),
+    re_path(r'^editable/', views.editable_view),
+    re_path(r'^panel/', views.panel_view),
+    re_path(r'^publish/', views.publish_view),
+    re_path(r'^render-block/', views.render_block_view),
 ]
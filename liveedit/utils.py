@@ -1,3 +1,10 @@
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+
+import hashlib
+import json
+
 def is_enabled(request):
     """
     This is called before the liveedit functionality is inserted into a page.
@@ -10,7 +17,65 @@ def is_enabled(request):
     You may also want to perform your own admin-only cookie check here, to avoid
     `request.user` being accessed by the subsequent `is_authenticated` check,
     since this will access the session, setting the `Vary: Cookie` header and
-    spoiling the cacheability of the page.
+    spoiling the cacheability of the page. `is_editor_cookie_present` below
+    provides such a check.
 
     """
     return True
+
+def get_editor_cookie_settings():
+    """
+    Return the name, signing salt and maximum age (in seconds) of the "editor
+    present" cookie.
+    """
+    return (
+        getattr(settings, 'LIVEEDIT_EDITOR_COOKIE_NAME', 'liveedit_editor'),
+        'liveedit.editor',
+        getattr(settings, 'LIVEEDIT_EDITOR_COOKIE_AGE', 12 * 60 * 60),
+    )
+
+def is_editor_cookie_present(request):
+    """
+    An alternative to `is_enabled`, which only enables liveedit if the request
+    has a valid "editor present" cookie, as set for admin users by
+    `liveedit.middleware.EditorCookieMiddleware`. The cookie is signed and
+    expires, and checking it never touches the session, so pages for
+    anonymous visitors remain cacheable.
+
+    To use it, set `LIVEEDIT_ENABLED_CHECK` to
+    `'liveedit.utils.is_editor_cookie_present'`.
+    """
+    if request is None:
+        return False
+
+    name, salt, max_age = get_editor_cookie_settings()
+    try:
+        return request.get_signed_cookie(name, salt=salt, max_age=max_age)=='1'
+    except (KeyError, signing.BadSignature):
+        return False
+
+DRAFT_MODE_SESSION_KEY = 'liveedit_draft_mode'
+
+def is_draft_mode(request):
+    """
+    Whether live edits should be saved into a draft revision, to be published
+    later with the "Publish changes" button, rather than being published
+    straight away.
+
+    Defaults to the `LIVEEDIT_DRAFT_MODE` setting, which editors can override
+    for their session.
+    """
+    default = getattr(settings, 'LIVEEDIT_DRAFT_MODE', False)
+    session = getattr(request, 'session', None)
+    if session is None:
+        return default
+    return session.get(DRAFT_MODE_SESSION_KEY, default)
+
+def get_stream_version(stream_value):
+    """
+    Return a token identifying the content of a StreamValue as stored, so that
+    changes can be checked against the version of the content they were based
+    on, to detect conflicting edits.
+    """
+    raw_data = json.dumps(list(stream_value.raw_data), sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha1(raw_data.encode('utf-8')).hexdigest()[:16]
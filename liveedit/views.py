@@ -1,25 +1,59 @@
 from django import forms
 from django.contrib.auth.decorators import permission_required
-from django.http import HttpResponse, HttpResponseRedirect
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.forms.utils import ErrorList
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware, get_token
 from django.shortcuts import render
+from django.template import Engine, RequestContext
 from django.template.loader import render_to_string
+from django.utils import translation
 from django.utils.safestring import mark_safe
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
 import wagtail
 if wagtail.VERSION < (3,):
-    from wagtail.core.blocks import BlockWidget
+    from wagtail.core.blocks import BlockWidget, ChooserBlock, ListBlock, StreamBlock, StructBlock
     from wagtail.core.blocks.stream_block import StreamValue
+    from wagtail.core.blocks.struct_block import StructBlockValidationError
+    from wagtail.core.models import Page
 else:
-    from wagtail.blocks import BlockWidget
+    from wagtail.blocks import BlockWidget, ChooserBlock, ListBlock, StreamBlock, StructBlock
     from wagtail.blocks.stream_block import StreamValue
+    from wagtail.blocks.struct_block import StructBlockValidationError
+    from wagtail.models import Page
+
+try:
+    # Wagtail >= 2.16
+    from wagtail.blocks.list_block import ListValue
+except ImportError:
+    try:
+        from wagtail.core.blocks.list_block import ListValue
+    except ImportError:
+        ListValue = None
 
 from collections.abc import Sequence
+import copy
 import json
+import os
 import re
+import uuid
 
-from .forms import BlockActionForm, BlockAppendForm, BlockEditForm
+from .forms import (
+    BlockActionForm, BlockAppendForm, BlockBatchForm, BlockEditForm, BlockRenderForm,
+    check_can_publish, has_drafts,
+)
+from .permissions import get_page_draft_url, get_permission_resolver
+from .side_effects import defer_side_effects
+from .utils import DRAFT_MODE_SESSION_KEY, get_stream_version, is_draft_mode
+# Ensure the templatetags' monkey-patches are applied before any revisions are
+# loaded, so that re-rendered blocks match those rendered in the page.
+from .templatetags import liveedit as liveedit_tags
 
 def islist(v):
     return isinstance(v, Sequence)
@@ -27,103 +61,572 @@ def islist(v):
 def isdict(v):
     return isinstance(v, dict)
 
-def _find_block(stream_value, raw_data, block_id):
-    for i in range(len(raw_data)):
-        # have we found the block we're looking for?
-        if raw_data[i]['id']==block_id:
-            def set_value(val):
-                stream_value[i].value = val
-            return stream_value[i].block, stream_value[i].value, set_value, stream_value
-
-        # is this a streamblock/listblock?
-        if islist(raw_data[i]['value']) and len(raw_data[i]['value']) and hasattr(raw_data[i]['value'][0], 'get') and raw_data[i]['value'][0].get('id'):
-            # stream_value[i] may be a StreamValue or a StreamValue.StreamChild
-            value = stream_value[i].value if isinstance(stream_value[i], StreamValue.StreamChild) else stream_value[i]
-            rb, rv, rsv, rp = _find_block(value, raw_data[i]['value'], block_id)
-            if rb:
-                return rb, rv, rsv, rp
-
-        #check structblock field values for any potential block lists
-        if isdict(raw_data[i]['value']):
-            for k, v in raw_data[i]['value'].items():
-                if islist(v) and len(v) and hasattr(v[0], 'get') and v[0].get('id'):
-                    rb, rv, rsv, rp = _find_block(stream_value[i].value[k], v, block_id)
-                    if rb:
-                        return rb, rv, rsv, rp
-
-    return None, None, None, None
-
-def find_block(stream_value, block_id):
+def isblocklist(v):
+    """
+    Whether the raw value is a list of blocks with ids, ie the raw data of a
+    StreamBlock or ListBlock.
+    """
+    return islist(v) and len(v) and hasattr(v[0], 'get') and v[0].get('id')
+
+def index_blocks(raw_data):
+    """
+    Build a map of block id -> path for every block within the raw data of a
+    StreamValue, in a single pass.
+
+    Recurses into StreamBlock and ListBlock items, and also into StructBlock
+    fields. A path is a tuple of steps, each of which is either an index into
+    a list of blocks, or a StructBlock field name (which applies to the
+    value of the block found by the previous step).
+    """
+    index = {}
+
+    def visit_value(value, path):
+        if isblocklist(value):
+            for i, item in enumerate(value):
+                if item.get('id'):
+                    index[item['id']] = path + (i,)
+                visit_value(item.get('value'), path + (i,))
+
+        elif isdict(value):
+            # check structblock field values for any potential block lists
+            for k, v in value.items():
+                visit_value(v, path + (k,))
+
+    visit_value(raw_data, ())
+    return index
+
+def find_block_path(stream_value, block_id):
+    """
+    Return the path of the block with the given id within the stream_value.
+    """
+    path = index_blocks(stream_value.raw_data).get(block_id)
+    if path is None:
+        raise Exception("Couldn't find block %s in %s"%(block_id, stream_value))
+    return path
+
+def resolve_raw_path(raw_data, path):
+    """
+    Follow a path (from index_blocks) through the raw data, returning a tuple
+    of (raw list of blocks containing the block, index of the block within it).
+    """
+    blocks = raw_data
+    for step in path[:-1]:
+        if isinstance(step, int):
+            blocks = blocks[step]['value']
+        else:
+            blocks = blocks[step]
+    return blocks, path[-1]
+
+def resolve_block_path(stream_value, path):
+    """
+    Follow a path (from index_blocks) through the raw data of the StreamValue
+    alongside the block definitions, without converting any values.
+
+    Returns a tuple of (Block, raw item of the block - a dict of its id, value
+and so on, the StreamBlock or ListBlock containing it).
+    """
+    block, raw, item, parent_block = stream_value.stream_block, stream_value.raw_data, None, None
+    for step in path:
+        if isinstance(step, int):
+            parent_block, item = block, raw[step]
+            if isinstance(block, ListBlock):
+                block = block.child_block
+            else:
+                block = block.child_blocks[item['type']]
+            raw = item['value']
+        else:
+            block = block.child_blocks[step]
+            raw = raw[step]
+    return block, item, parent_block
+
+def bind_raw_path(stream_value, path):
+    """
+    Follow a path (from index_blocks) through the raw data of the StreamValue,
+    converting only the value of the block at the end of it, so that the
+    values of its siblings (and any objects chosen within them) aren't loaded.
+
+    Returns a tuple of (StreamValue.StreamChild or ListValue.ListChild, the
+    StreamBlock or ListBlock containing it).
+    """
+    block, item, parent_block = resolve_block_path(stream_value, path)
+    value = block.to_python(item['value'])
+    if isinstance(parent_block, ListBlock):
+        child = ListValue.ListChild(block, value, id=item.get('id'))
+    else:
+        child = StreamValue.StreamChild(block, value, id=item.get('id'))
+    return child, parent_block
+
+def modify_raw_blocks(stream_value, path, modify):
+    """
+    Call `modify(blocks, index)` with the raw list of blocks containing the
+    block at the path (from index_blocks) and its index, to change the blocks
+    in place, making sure that the StreamValue will save the change.
+    """
+    modify(*resolve_raw_path(stream_value.raw_data, path))
+    if len(path) > 1:
+        # The change is nested within a top-level block, so its value (if
+        # already converted) is out of date - reassigning the raw data
+        # discards it.
+        stream_value.raw_data[path[0]] = stream_value.raw_data[path[0]]
+
+def find_block(stream_value, block_id, path=None):
     """
     Search through the stream_value to find the block with the given id.
 
     Recurses into StreamBlock and ListBlock items, and also into StructBlock
-    fields.
+    fields. If the block's path (from index_blocks) is already known, it can be
+    supplied to avoid searching again. Only the block itself is converted from
+    the raw data (see bind_raw_path).
 
-    Returns a tuple of (Block, StreamValue.StreamChild, setter function to
-    update value, parent StreamValue)
+    Returns a tuple of (Block, value, setter function to update value, parent
+    StreamBlock or ListBlock)
     """
 
-    block, value, set_value, parent_value = _find_block(stream_value, stream_value.raw_data, block_id)
-    if block is None:
-        raise Exception("Couldn't find block %s in %s"%(block_id, stream_value))
-        
-    return block, value, set_value, parent_value
-
-def modify_block(action, blocks, block_id):
-    for i in range(len(blocks)):
-        if action=="move_up" and i>0 and blocks[i]['id']==block_id:
-            #swap with previous
-            blocks[i-1], blocks[i] = blocks[i], blocks[i-1]
-            return True #did the move
-        elif action=="move_down" and i<(len(blocks)-1) and blocks[i]['id']==block_id:
-            #swap with next
-            blocks[i+1], blocks[i] = blocks[i], blocks[i+1]
-            return True #did the move
-
-        #is this a list?
-        if islist(blocks[i]['value']):
-            for v in blocks[i]['value']:
-                if islist(v) and len(v) and hasattr(v[0], 'get') and v[0].get('id'):
-                    if modify_block(action, v, block_id):
-                        #if block was moved, stop looking
-                        return True
-
-        #search through all fields for any potential block lists
-        if isdict(blocks[i]['value']):
-            for v in blocks[i]['value'].values():
-                if islist(v) and len(v) and hasattr(v[0], 'get') and v[0].get('id'):
-                    if modify_block(action, v, block_id):
-                        #if block was moved, stop looking
-                        return True
-
-def render_edit_panel(request, d):
-    # Steal all of the <script> and stylesheet tags from the admin base template
-    admin_base = render_to_string("wagtailadmin/admin_base.html", request=request)
-    script_tags = mark_safe("\n".join(re.findall('<script[^>]*>.*?</script>', admin_base, re.DOTALL)))
-    stylesheet_tags = mark_safe("\n".join(re.findall('<link rel="stylesheet"[^>]+/?>', admin_base, re.DOTALL)))
-
-    editor_css = ""
-    if wagtail.VERSION < (4,):
-        editor_css = mark_safe(render_to_string("wagtailadmin/pages/_editor_css.html", request=request))
+    if path is None:
+        path = find_block_path(stream_value, block_id)
+
+    child, parent_block = bind_raw_path(stream_value, path)
+
+    def set_value(val):
+        child.value = val
+        def replace(blocks, i):
+            blocks[i] = {**blocks[i], 'value': child.block.get_prep_value(val)}
+        modify_raw_blocks(stream_value, path, replace)
+
+    return child.block, child.value, set_value, parent_block
+
+def modify_block(action, blocks, block_id, path=None, index=None):
+    """
+    Apply an action to the block with the given id, within the raw data of a
+    StreamValue. Returns True if the blocks were changed.
+
+    The actions are `move_up`, `move_down`, `move` (to the given `index`
+    among its siblings) and `delete`.
+    """
+    if path is None:
+        path = index_blocks(blocks).get(block_id)
+        if path is None:
+            return False
+
+    siblings, i = resolve_raw_path(blocks, path)
+
+    if action=="move_up" and i>0:
+        #swap with previous
+        siblings[i-1], siblings[i] = siblings[i], siblings[i-1]
+        return True #did the move
+    elif action=="move_down" and i<(len(siblings)-1):
+        #swap with next
+        siblings[i+1], siblings[i] = siblings[i], siblings[i+1]
+        return True #did the move
+    elif action=="move" and index is not None:
+        index = max(0, min(index, len(siblings)-1))
+        if index!=i:
+            siblings.insert(index, siblings.pop(i))
+            return True
+    elif action=="delete":
+        del siblings[i]
+        return True
+
+    return False
+
+def duplicate_block(blocks, block_id, path=None):
+    """
+    Insert a copy of the block with the given id after it, within the raw data
+    of a StreamValue. The copy, and any blocks within it, are given new ids.
+    Returns the id of the copy, or None if the block couldn't be found.
+    """
+    if path is None:
+        path = index_blocks(blocks).get(block_id)
+        if path is None:
+            return None
+
+    siblings, i = resolve_raw_path(blocks, path)
+
+    def renew_ids(value):
+        if isblocklist(value):
+            for item in value:
+                item['id'] = str(uuid.uuid4())
+                renew_ids(item.get('value'))
+        elif isdict(value):
+            for v in value.values():
+                renew_ids(v)
+
+    duplicate = copy.deepcopy(siblings[i])
+    renew_ids([duplicate])
+    siblings.insert(i+1, duplicate)
+    return duplicate['id']
+
+def reorder_blocks(blocks, ids):
+    """
+    Reorder a list of sibling blocks, within the raw data of a StreamValue, to
+    match the given list of all of their ids. Returns True if the order
+    changed.
+    """
+    path = index_blocks(blocks).get(ids[0]) if ids else None
+    if path is None:
+        raise ValueError("Couldn't find block %s" % (ids[0] if ids else None))
+
+    siblings, _ = resolve_raw_path(blocks, path)
+    by_id = {b.get('id'): b for b in siblings}
+    if len(ids)!=len(siblings) or set(ids)!=set(by_id):
+        raise ValueError("The ids to reorder must be all of the blocks' siblings")
+
+    changed = False
+    for j, block_id in enumerate(ids):
+        if siblings[j].get('id')!=block_id:
+            siblings[j] = by_id[block_id]
+            changed = True
+    return changed
+
+def apply_block_operations(blocks, operations):
+    """
+    Apply a list of operations to the raw data of a StreamValue, in order.
+
+    Each operation is a dict with an `action`, and the `id` of the block it
+    applies to. The actions are those of `modify_block`, as well as
+    `duplicate`, and `reorder`, which takes a list of `ids` (see
+    `reorder_blocks`) instead of an `id`.
+
+    Returns a list of results for the operations, as dicts saying whether the
+    blocks were `changed`, and the `id` of the copy for duplicated blocks.
+    Raises ValueError if an operation is invalid, in which case the raw data
+    may have been partially modified.
+    """
+    results = []
+    for op in operations:
+        action, block_id = op.get('action'), op.get('id')
+
+        if action=="reorder":
+            ids = op.get('ids')
+            if not islist(ids):
+                raise ValueError("Expected a list of ids to reorder")
+            results.append({'changed': reorder_blocks(blocks, list(ids))})
+            continue
+
+        path = index_blocks(blocks).get(block_id)
+        if path is None:
+            raise ValueError("Couldn't find block %s" % block_id)
+
+        if action=="duplicate":
+            results.append({'changed': True, 'id': duplicate_block(blocks, block_id, path)})
+        elif action in ("move_up", "move_down", "move", "delete"):
+            index = op.get('index')
+            if action=="move" and not isinstance(index, int):
+                raise ValueError("Expected an index to move block %s to" % block_id)
+            results.append({'changed': modify_block(action, blocks, block_id, path, index)})
+        else:
+            raise ValueError("Unknown action %r" % action)
+
+    return results
+
+def collect_chosen_objects(block, value, found):
+    """
+    Add the model instances chosen by any chooser blocks within the block's
+    value to the `found` list.
+    """
+    if value is None:
+        return
+
+    if isinstance(block, ChooserBlock):
+        if hasattr(value, '_meta'):
+            found.append(value)
+    elif isinstance(value, StreamValue):
+        for child in value:
+            collect_chosen_objects(child.block, child.value, found)
+    elif isinstance(block, ListBlock):
+        for item in value:
+            collect_chosen_objects(block.child_block, item, found)
+    elif isinstance(block, StructBlock):
+        for name, child_block in block.child_blocks.items():
+            collect_chosen_objects(child_block, value.get(name), found)
+
+def prefetch_chooser_data(block, value):
+    """
+    Bulk load the data which the chooser widgets in a block's edit form need
+    for each chosen object, which they would otherwise each query for: the
+    preview renditions of images, and the specific pages and their parents
+    for pages.
+
+    (The chosen objects themselves are already bulk loaded by Wagtail.)
+    """
+    found = []
+    collect_chosen_objects(block, value, found)
+
+    images = [obj for obj in found if hasattr(obj, 'get_rendition_model')]
+    if images:
+        prefetch_related_objects(images, Prefetch(
+            'renditions',
+            # as used by wagtail.images.widgets.AdminImageChooser
+            queryset=images[0].get_rendition_model().objects.filter(filter_spec='max-165x165'),
+        ))
+
+    pages = [obj for obj in found if isinstance(obj, Page)]
+    if pages:
+        # the page chooser uses the specific page, and its parent
+        generic_pages = [page for page in pages if page.specific_class not in (None, type(page))]
+        specific_pages = {
+            page.pk: page
+            for page in Page.objects.filter(pk__in={page.pk for page in generic_pages}).specific()
+        } if generic_pages else {}
+        parent_paths = {page.path[:-page.steplen] for page in pages if page.depth > 1}
+        parents = {
+            parent.path: parent for parent in Page.objects.filter(path__in=parent_paths)
+        } if parent_paths else {}
+
+        for page in pages:
+            if page.pk in specific_pages:
+                # as cached by Page.specific
+                page.__dict__['specific'] = specific_pages[page.pk]
+            if page.depth > 1:
+                # as cached by treebeard's MP_Node.get_parent
+                page.specific._cached_parent_obj = parents.get(page.path[:-page.steplen])
+
+# Per-process cache of the tags scraped from the admin base template, keyed on
+# the active language, as (signature, tags) (see get_admin_tags).
+_admin_tags_cache = {}
+
+def _static_manifest_signature():
+    """
+    Return a value which changes whenever the static files manifest does, if
+    the static files storage uses one.
+    """
+    manifest_name = getattr(staticfiles_storage, 'manifest_name', None)
+    if not manifest_name:
+        return None
+    storage = getattr(staticfiles_storage, 'manifest_storage', staticfiles_storage)
+    try:
+        st = os.stat(storage.path(manifest_name))
+    except (NotImplementedError, OSError):
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def get_admin_tags(request):
+    """
+    Return the <script> and stylesheet tags from the admin base template, as
+    well as any extra editor CSS, as a tuple of (script_tags, stylesheet_tags,
+    editor_css).
+
+    Rendering the admin base template is expensive, so the scraped tags are
+    cached per process for each language, and re-scraped whenever the Wagtail
+    version or the static files manifest changes. The `wagtail-config` script
+    contains a CSRF token and user preferences, so it is re-rendered for each
+    request.
+    """
+    language = translation.get_language()
+    signature = (wagtail.VERSION, _static_manifest_signature())
+    cached_signature, tags = _admin_tags_cache.get(language, (None, None))
+    if tags is None or cached_signature != signature:
+        # Steal all of the <script> and stylesheet tags from the admin base template
+        admin_base = render_to_string("wagtailadmin/admin_base.html", request=request)
+        script_tags = [
+            # leave a placeholder for the per-request config
+            None if 'id="wagtail-config"' in tag else tag
+            for tag in re.findall('<script[^>]*>.*?</script>', admin_base, re.DOTALL)
+        ]
+        stylesheet_tags = re.findall('<link rel="stylesheet"[^>]+/?>', admin_base, re.DOTALL)
+
+        editor_css = ""
+        if wagtail.VERSION < (4,):
+            editor_css = render_to_string("wagtailadmin/pages/_editor_css.html", request=request)
+
+        tags = (script_tags, stylesheet_tags, editor_css)
+        # Replacing any tags scraped with an older manifest
+        _admin_tags_cache[language] = (signature, tags)
+
+    script_tags, stylesheet_tags, editor_css = tags
+    return (
+        mark_safe("\n".join(
+            render_to_string("liveedit/wagtail_config.html", request=request) if tag is None else tag
+            for tag in script_tags
+        )),
+        mark_safe("\n".join(stylesheet_tags)),
+        mark_safe(editor_css),
+    )
+
+def is_fragment(request):
+    """
+    Whether the edit panel has asked for just its form, rather than a whole
+    page (see `render_edit_panel`).
+    """
+    return bool(request.GET.get('fragment'))
+
+def render_edit_panel(request, d, status=200):
+    """
+    Render the edit panel, as a whole page to be loaded in an iframe.
+
+    With the `fragment` parameter, only the form's HTML and media are returned,
+    as JSON, for an edit panel which is already open to swap in (see
+    `edit_panel.html`) - the panel then only needs to load the scripts and
+    stylesheets that it hasn't already.
+    """
+    if is_fragment(request):
+        media = d['form_media']
+        return JsonResponse({
+            'form_html': str(d['form_html']),
+            'media': {
+                'js': list(media.render_js()),
+                'css': list(media.render_css()),
+            },
+            'version': d.get('version'),
+            'conflict': bool(d.get('conflict')),
+            'delta_children': d.get('delta_children'),
+        }, status=status)
+
+    script_tags, stylesheet_tags, editor_css = get_admin_tags(request)
 
     ret = render(request, "liveedit/edit_panel.html", {
         **d,
         'script_tags': script_tags,
         'stylesheet_tags': stylesheet_tags,
         'editor_css': editor_css
-    })
+    }, status=status)
     ret['X-Frame-Options'] = 'SAMEORIGIN'
     return ret
 
-def ReloadResponse(jump_to_id=None):
-    msg = {'action':"reload", 'jump_to_id':jump_to_id}
+def render_block(request, obj, content_type, field, child, version=None):
+    """
+    Render a single block as `liveedit_include_block` would have rendered it
+    within the page, returning a tuple of (html, whether the whole page should
+    be reloaded instead).
+
+    `version` is the version of the StreamField's content (see
+    `get_stream_version`) that the block was rendered from.
+
+    The block is rendered with the request's context processors, but without
+    any extra context the page's own view would have added.
+    """
+    request._live_edit_requires_reload = False
+
+    liveedit_data = {
+        'id': child.id,
+        'block_type': getattr(child, 'block_type', child.block.name),
+        'content_type_id': content_type.id,
+        'object_id': obj.id,
+        'object_field': field,
+    }
+    if version:
+        liveedit_data['version'] = version
+
+    context = RequestContext(request, {'request': request})
+    if isinstance(obj, Page):
+        context['page'] = obj
+    # Context processors are only run once the context is bound to a template
+    with context.bind_template(Engine.get_default().from_string('')):
+        html = liveedit_tags._render_block(child, context, liveedit_data=liveedit_data)
+    return html, request._live_edit_requires_reload
+
+def is_conflicting(request, form):
+    """
+    Whether the posted change was based on a different version of the
+    StreamField's content than is now stored, ie someone else has changed it
+    in the meantime.
+    """
+    version = request.POST.get('version')
+    return bool(version) and version!=form.cleaned_data['version']
+
+def PanelMessageResponse(request, msg):
+    """
+    Pass a message from the edit panel to the page's Javascript, once the
+    panel's form has been saved.
+    """
+    if request is not None and is_fragment(request):
+        return JsonResponse(msg)
     ret = HttpResponse('''
     <script>window.parent.postMessage(''' + json.dumps(msg) + ''', '*');</script>
     ''')
     ret['X-Frame-Options'] = 'SAMEORIGIN'
     return ret
 
+def RerenderResponse(block_id, request=None, draft=None):
+    msg = {'action':"rerender", 'id':block_id}
+    if draft:
+        msg['draft'] = draft
+    return PanelMessageResponse(request, msg)
+
+def ReloadResponse(jump_to_id=None, request=None, draft=None):
+    msg = {'action':"reload", 'jump_to_id':jump_to_id}
+    if draft:
+        msg['draft'] = draft
+    return PanelMessageResponse(request, msg)
+
+def get_saved_draft(request, form, revision_id):
+    """
+    Describe the draft revision that a change was saved into in draft mode,
+    so that the frontend can ask for that revision (and not someone else's
+    later draft) to be published, and show the draft rather than the live
+    page when it reloads. Returns None for other changes.
+    """
+    obj = form.cleaned_data['revision']
+    if revision_id is None or not is_draft_mode(request) or not has_drafts(obj):
+        return None
+    draft = {
+        'content_type_id': form.cleaned_data['content_type'].id,
+        'object_id': form.cleaned_data['object_id'],
+        'revision_id': revision_id,
+    }
+    if isinstance(obj, Page):
+        # The live page's blocks can't be edited now that it has a draft, so
+        # the frontend reloads this instead
+        draft['url'] = get_page_draft_url(obj, revision_id)
+    return draft
+
+def supports_delta(block):
+    """
+    Whether changes to a block can be submitted as a delta, ie only the
+    children of a StructBlock which have changed, so that just those are
+    cleaned (rather than, say, looking up every chooser's value again).
+    """
+    return (
+        isinstance(block, StructBlock)
+        and type(block).value_from_datadict is StructBlock.value_from_datadict
+        and type(block).clean is StructBlock.clean
+    )
+
+def get_delta(request, block):
+    """
+    Return the names of the changed children of the block, if the edit panel
+    submitted only those, or None if it submitted the whole block.
+    """
+    if not supports_delta(block):
+        return None
+    try:
+        names = json.loads(request.POST.get('liveedit_delta', ''))
+    except ValueError:
+        return None
+    if not islist(names):
+        return None
+    return [name for name in block.child_blocks if name in names]
+
+def value_from_delta(block, value, names, data, files, prefix):
+    """
+    Return the StructBlock's existing value, with the named children replaced
+    by their values from the submitted form data.
+    """
+    return block._to_struct_value([
+        (name, child_block.value_from_datadict(data, files, '%s-%s' % (prefix, name)) if name in names else value[name])
+        for name, child_block in block.child_blocks.items()
+    ])
+
+def clean_delta(block, value, names):
+    """
+    Clean a StructBlock's value like `StructBlock.clean`, but only the named
+    children, since the others are unchanged (and so already clean).
+    """
+    result = []
+    errors = {}
+    for name, val in value.items():
+        if name in names:
+            try:
+                val = block.child_blocks[name].clean(val)
+            except forms.ValidationError as e:
+                errors[name] = e if wagtail.VERSION >= (5,) else ErrorList([e])
+        result.append((name, val))
+
+    if errors:
+        raise StructBlockValidationError(errors)
+
+    return block._to_struct_value(result)
+
 # wrapper to workaround Wagtail's assumption that all blocks have a top level StreamBlock
 class ErrorWrapper:
     def __init__(self, err):
@@ -142,14 +645,32 @@ def wrap_error(err):
 
     return ErrorWrapper(err)
 
+def check_csrf(request):
+    """
+    Apply the CSRF check to a request to a view which is exempt from it,
+    returning the response refusing it if it fails, or None.
+    """
+    return CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {})
+
 @csrf_exempt
 @require_http_methods(["POST"])
 @permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+@transaction.atomic
 def action_view(request):
+    if request.POST.get('format')=='json':
+        # Only the form posted by older versions of the frontend is exempt,
+        # the frontend's own requests send the token
+        refused = check_csrf(request)
+        if refused:
+            return refused
+
     form = BlockActionForm(request.POST, request=request)
     if not form.is_valid():
         return HttpResponse(str(form.errors), status=400)
 
+    if is_conflicting(request, form):
+        return action_conflict_response(request, form)
+
     save, value, block_id, action, redirect_url = (
         form.cleaned_data['save'],
         form.cleaned_data['value'],
@@ -158,12 +679,111 @@ def action_view(request):
         form.cleaned_data['redirect_url'],
     )
 
-    modify_block(action, value.raw_data, block_id)
-    save()
+    if request.POST.get('format')!='json' and not redirect_url:
+        # Go back to the page the action came from
+        redirect_url = request.META.get('HTTP_REFERER')
+        if not redirect_url:
+            return HttpResponse("Expected a redirect_url", status=400)
+
+    path = index_blocks(value.raw_data).get(block_id)
+    moved = path is not None and modify_block(action, value.raw_data, block_id, path)
+    revision_id = save() if moved else None
+    draft = get_saved_draft(request, form, revision_id)
+
+    if request.POST.get('format')=='json':
+        # Describe the move, so the frontend can reorder the blocks in place
+        if path is None:
+            return JsonResponse({'error': "Couldn't find block %s" % block_id}, status=400)
+
+        siblings, i = resolve_raw_path(value.raw_data, path)
+        order = [b.get('id') for b in siblings]
+        new_index = order.index(block_id)
+        return JsonResponse({
+            'moved': moved,
+            'order': order,
+            'affected': order[min(i, new_index):max(i, new_index)+1],
+            'revision_id': revision_id,
+            'draft': draft,
+            'version': get_stream_version(value),
+        })
+
+    if draft and draft.get('url'):
+        # Show the draft, at the same block, since the live page's blocks
+        # can't be edited now
+        fragment = redirect_url.partition('#')[2]
+        redirect_url = draft['url'] + ('#' + fragment if fragment else '')
 
     return HttpResponseRedirect(redirect_url)
 
+def action_conflict_response(request, form):
+    """
+    Respond to an action based on an out of date version of the StreamField,
+    including the block as it is now, if it still exists.
+    """
+    value, block_id = form.cleaned_data['value'], form.cleaned_data['id']
+    if request.POST.get('format')!='json':
+        return HttpResponse("Block %s has been changed by someone else" % block_id, status=409)
+
+    html = None
+    path = index_blocks(value.raw_data).get(block_id)
+    if path is not None:
+        child, _ = bind_raw_path(value, path)
+        html, _ = render_block(
+            request,
+            form.cleaned_data['revision'],
+            form.cleaned_data['content_type'],
+            form.cleaned_data['object_field'],
+            child,
+            form.cleaned_data['version'],
+        )
+
+    return JsonResponse({
+        'conflict': True,
+        'html': html,
+        'version': form.cleaned_data['version'],
+    }, status=409)
+
+@require_http_methods(["POST"])
 @permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+@transaction.atomic
+def batch_view(request):
+    """
+    Apply a list of operations (see `apply_block_operations`) to the blocks of
+    a StreamField together, saving them once. If any operation is invalid,
+    nothing is saved.
+    """
+    form = BlockBatchForm(request.POST, request=request)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    if is_conflicting(request, form):
+        return JsonResponse({
+            'conflict': True,
+            'version': form.cleaned_data['version'],
+        }, status=409)
+
+    save, value = (
+        form.cleaned_data['save'],
+        form.cleaned_data['value'],
+    )
+
+    try:
+        results = apply_block_operations(value.raw_data, form.cleaned_data['operations'])
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    changed = any(result['changed'] for result in results)
+    revision_id = save() if changed else None
+
+    return JsonResponse({
+        'results': results,
+        'revision_id': revision_id,
+        'draft': get_saved_draft(request, form, revision_id),
+        'version': get_stream_version(value),
+    })
+
+@permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+@transaction.atomic
 def edit_block_view(request):
     form = BlockEditForm(request.GET, request=request)
     if not form.is_valid():
@@ -175,38 +795,204 @@ def edit_block_view(request):
         form.cleaned_data['id']
     )
 
-    block, block_value, set_value, parent = find_block(value, block_id)
+    path = find_block_path(value, block_id)
+    block, block_value, set_value, _ = find_block(value, block_id, path)
 
     errors = wrap_error(None)
-    if request.method=="POST" and request.POST.get('delete'):
-        for i, block in enumerate(parent):
-            if block.id==block_id:
-                del parent[i]
-                save()
-                return ReloadResponse()
+    # On a conflict, the block is shown as it is now, rather than overwriting
+    # someone else's changes
+    conflict = request.method=="POST" and is_conflicting(request, form)
+    saving = request.method=="POST" and not conflict
 
-    elif request.method=="POST":
-        val = block.value_from_datadict(request.POST, request.FILES, 'block_edit_form')
+    if saving and request.POST.get('delete'):
+        modify_raw_blocks(value, path, lambda blocks, i: blocks.pop(i))
+        revision_id = save()
+        return ReloadResponse(request=request, draft=get_saved_draft(request, form, revision_id))
+
+    elif saving:
+        delta = get_delta(request, block)
+        if delta is None:
+            val = block.value_from_datadict(request.POST, request.FILES, 'block_edit_form')
+        else:
+            val = value_from_delta(block, block_value, delta, request.POST, request.FILES, 'block_edit_form')
         try:
-            val = block.clean(val)
+            val = block.clean(val) if delta is None else clean_delta(block, val, delta)
 
             set_value(val)
-            save()
+            revision_id = save()
 
-            return ReloadResponse(block_id)
+            return RerenderResponse(block_id, request, get_saved_draft(request, form, revision_id))
 
         except forms.ValidationError as e:
             errors = wrap_error(e)
             block_value = val
 
     bw = BlockWidget(block)
+    prefetch_chooser_data(block, block_value)
 
     return render_edit_panel(request, {
         'form_html': bw.render_with_errors('block_edit_form', block_value, errors=errors),
         'form_media': bw.media,
+        'version': form.cleaned_data['version'],
+        'conflict': conflict,
+        'delta_children': list(block.child_blocks) if supports_delta(block) else None,
+    }, status=409 if conflict else 200)
+
+@require_http_methods(["GET", "POST"])
+@permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+def draft_mode_view(request):
+    """
+    Report whether draft mode (see `is_draft_mode`) is on for the user's
+    session, or on POST, turn it on or off with the `draft_mode` parameter.
+    """
+    if request.method=="POST":
+        request.session[DRAFT_MODE_SESSION_KEY] = request.POST.get('draft_mode')=='1'
+    return JsonResponse({'draft_mode': is_draft_mode(request)})
+
+@require_http_methods(["POST"])
+@permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+@transaction.atomic
+def publish_view(request):
+    """
+    Publish the drafts of the objects given as a JSON list of dicts with
+    `content_type_id`, `object_id` and `revision_id` keys in the `objects`
+    parameter, where `revision_id` is the draft revision that the editor's
+    changes were saved into in draft mode (see `get_saved_draft`).
+
+    Objects without a draft are skipped. If any object's latest revision is
+    not the given one (ie someone else has saved a draft of it since),
+    nothing is published.
+    """
+    try:
+        objects = json.loads(request.POST.get('objects', ''))
+    except ValueError:
+        objects = None
+    if not isinstance(objects, list) or not all(isinstance(data, dict) for data in objects):
+        return HttpResponse("Expected a JSON list of objects", status=400)
+
+    # Check every object before publishing any of them
+    drafts, seen = [], set()
+    for data in objects:
+        try:
+            key = (int(data['content_type_id']), int(data['object_id']))
+            revision_id = int(data['revision_id'])
+        except (KeyError, TypeError, ValueError):
+            return HttpResponse("Invalid object", status=400)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        try:
+            model_class = ContentType.objects.get_for_id(key[0]).model_class()
+            obj = model_class._default_manager.get(pk=key[1])
+        except (AttributeError, ObjectDoesNotExist):
+            return HttpResponse("Invalid object", status=400)
+
+        if not has_drafts(obj) or not obj.has_unpublished_changes:
+            continue
+
+        try:
+            check_can_publish(request.user, obj)
+        except PermissionDenied:
+            return HttpResponse("Permission denied", status=403)
+
+        revision = obj.get_latest_revision()
+        if revision is None or revision.id!=revision_id:
+            return HttpResponse("%s has been changed by someone else" % obj, status=409)
+
+        drafts.append((key, revision))
+
+    published = []
+    for key, revision in drafts:
+        with defer_side_effects():
+            revision.publish(user=request.user)
+        published.append({
+            'content_type_id': key[0],
+            'object_id': key[1],
+            'revision_id': revision.id,
+        })
+
+    return JsonResponse({'published': published})
+
+@permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+def panel_view(request):
+    """
+    Render an empty edit panel, which the frontend loads in a hidden iframe
+    while the browser is idle, so that the admin scripts and stylesheets are
+    already loaded when a block is first edited. Forms are then swapped into
+    it as blocks are edited (see `render_edit_panel`).
+    """
+    response = render_edit_panel(request, {})
+    # only the assets are worth caching, not the page itself
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+def render_block_view(request):
+    """
+    Render a single block from the latest revision, so that the frontend can
+    replace just that block after it has been edited.
+    """
+    form = BlockRenderForm(request.GET, request=request)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    value, block_id = (
+        form.cleaned_data['value'],
+        form.cleaned_data['id'],
+    )
+
+    child, _ = bind_raw_path(value, find_block_path(value, block_id))
+    html, reload = render_block(
+        request,
+        form.cleaned_data['revision'],
+        form.cleaned_data['content_type'],
+        form.cleaned_data['object_field'],
+        child,
+        form.cleaned_data['version'],
+    )
+
+    return JsonResponse({
+        'html': '' if reload else html,
+        'reload': reload,
+        'version': form.cleaned_data['version'],
     })
 
 @permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+def editable_view(request):
+    """
+    For deferred mode, report which of the objects whose blocks are marked in
+    a page the user may edit. The `objects` parameter is a JSON list of the
+    markers' liveedit data, and the response lists their states in the same
+    order.
+    """
+    try:
+        objects = json.loads(request.GET.get('objects', ''))
+    except ValueError:
+        objects = None
+    if not isinstance(objects, list):
+        return HttpResponse("Expected a JSON list of objects", status=400)
+
+    if not liveedit_tags.is_enabled(request):
+        return JsonResponse({'objects': [{'editable': False} for data in objects]})
+
+    # Resolve all of the objects together, so they're loaded in bulk
+    verdicts = get_permission_resolver(request).resolve_references([
+        data if isinstance(data, dict) else {} for data in objects
+    ])
+
+    return JsonResponse({
+        'objects': [
+            {'editable': editable, 'draft_url': draft_url}
+            for editable, draft_url in verdicts
+        ],
+        # the page can't carry these, since it is shared
+        'csrf_token': get_token(request),
+        'draft_mode': is_draft_mode(request),
+    })
+
+@permission_required('wagtailadmin.access_admin', login_url='wagtailadmin_login')
+@transaction.atomic
 def append_block_view(request):
     form = BlockAppendForm(request.GET, request=request)
     if not form.is_valid():
@@ -219,51 +1005,56 @@ def append_block_view(request):
     )
 
     if not block_id:
-        # No existing block, use the top-level StreamValue as the parent.
-        parent_value = value
+        # No existing block, so insert the new block(s) at the top of the
+        # top-level StreamValue.
+        parent_block = value.stream_block
+        insert_path = (0,)
     else:
-        # Find the block within the StreamValue and use its parent.
-        _, _, _, parent_value = find_block(value, block_id)
+        # Find the block within the StreamValue and insert after it, in its
+        # parent (without converting either's value).
+        path = find_block_path(value, block_id)
+        _, _, parent_block = resolve_block_path(value, path)
+        insert_path = path[:-1] + (path[-1] + 1,)
+
+    if not isinstance(parent_block, StreamBlock):
+        return HttpResponse("New blocks can only be inserted into a StreamBlock", status=400)
 
-    parent_block = parent_value.stream_block
-    blank_value = StreamValue(parent_value.stream_block, [])
+    blank_value = StreamValue(parent_block, [])
 
     errors = wrap_error(None)
-    if request.method=="POST":
+    conflict = request.method=="POST" and is_conflicting(request, form)
+    if conflict:
+        # Keep what was entered, so it can be inserted into the latest version
+        blank_value = parent_block.value_from_datadict(request.POST, request.FILES, 'block_edit_form')
+
+    elif request.method=="POST":
         val = parent_block.value_from_datadict(request.POST, request.FILES, 'block_edit_form')
         try:
             val = parent_block.clean(val)
 
-            # Default to inserting the new block(s) at the top
-            insert_index = 0
-            for i, v in enumerate(parent_value):
-                if block_id and v.id==block_id:
-                    # Insert after this block
-                    insert_index = i+1
-                    break
-
-            # Insert the new block(s) into the parent
-            for j, added in enumerate(val):
-                parent_value.insert(insert_index+j, added)
+            # Insert the new block(s) into the parent's raw data, so that
+            # the values of the other blocks needn't be converted
+            def insert(blocks, i):
+                for j, added in enumerate(val):
+                    item = added.get_prep_value()
+                    if not item.get('id'):
+                        item['id'] = str(uuid.uuid4())
+                    blocks.insert(i+j, item)
+            modify_raw_blocks(value, insert_path, insert)
 
-                # The above insert call leaves the _raw_data entry as None,
-                # which will cause search indexing to error - Wagtail probably
-                # isn't expecting us to meddle with StreamValues like this.
-                #
-                # Thus we also need to populate the _raw_data entry manually.
+            revision_id = save()
 
-                parent_value._raw_data[insert_index+j] = added.get_prep_value()
-
-            save()
-
-            return ReloadResponse()
+            return ReloadResponse(request=request, draft=get_saved_draft(request, form, revision_id))
         except forms.ValidationError as e:
             errors = wrap_error(e)
             blank_value = val
 
     bw = BlockWidget(parent_block)
+    prefetch_chooser_data(parent_block, blank_value)
 
     return render_edit_panel(request, {
         'form_html': bw.render_with_errors('block_edit_form', blank_value, errors=errors),
         'form_media': bw.media,
-    })
+        'version': form.cleaned_data['version'],
+        'conflict': conflict,
+    }, status=409 if conflict else 200)
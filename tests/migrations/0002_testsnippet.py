@@ -0,0 +1,41 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+try:
+    import wagtail.blocks as blocks
+    import wagtail.fields as fields
+except ImportError:
+    # Wagtail <5
+    import wagtail.core.blocks as blocks
+    import wagtail.core.fields as fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tests', '0001_initial'),
+        ('wagtailcore', '0070_rename_pagerevision_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestSnippet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('live', models.BooleanField(default=True, editable=False, verbose_name='live')),
+                ('has_unpublished_changes', models.BooleanField(default=False, editable=False, verbose_name='has unpublished changes')),
+                ('first_published_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='first published at')),
+                ('last_published_at', models.DateTimeField(editable=False, null=True, verbose_name='last published at')),
+                ('go_live_at', models.DateTimeField(blank=True, null=True, verbose_name='go live date/time')),
+                ('expire_at', models.DateTimeField(blank=True, null=True, verbose_name='expiry date/time')),
+                ('expired', models.BooleanField(default=False, editable=False, verbose_name='expired')),
+                ('title', models.CharField(max_length=255)),
+                ('body', fields.StreamField([('text', blocks.StructBlock([('body', blocks.RichTextBlock(required=False))], template='text_block.html'))], blank=True, null=True)),
+                ('latest_revision', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='wagtailcore.revision', verbose_name='latest revision')),
+                ('live_revision', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='wagtailcore.revision', verbose_name='live revision')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
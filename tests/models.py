@@ -1,9 +1,12 @@
+from django.db import models
+
 import wagtail
 from wagtail.admin.panels import FieldPanel
+from wagtail.snippets.models import register_snippet
 try:
     from wagtail import blocks
     from wagtail.fields import StreamField
-    from wagtail.models import Page
+    from wagtail.models import DraftStateMixin, Page, RevisionMixin
 except ImportError:
     # Wagtail <5
     from wagtail.core import blocks
@@ -56,3 +59,18 @@ class TestPage(Page):
     content_panels = Page.content_panels + [
         FieldPanel("body"),
     ]
+
+@register_snippet
+class TestSnippet(DraftStateMixin, RevisionMixin, models.Model):
+    title = models.CharField(max_length=255)
+
+    body = StreamField([
+
+        ('text', blocks.StructBlock([
+            ('body', blocks.RichTextBlock(required=False)),
+        ], template="text_block.html")),
+
+    ], **STREAMFIELD_ARGS, null=True, blank=True)
+
+    def __str__(self):
+        return self.title
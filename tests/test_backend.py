@@ -1,8 +1,13 @@
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, Group, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
 from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.shortcuts import render
+from django.template import Context, Template
 from django.template.loader import render_to_string
+from django.urls import reverse
 try:
     from django.test import RequestFactory
 except ImportError:
@@ -10,34 +15,49 @@ except ImportError:
     from django.tests import RequestFactory
 
 try:
-    from wagtail.models import Page
+    from wagtail.blocks import BlockWidget, CharBlock, ListBlock, PageChooserBlock, StreamBlock, StructBlock
+    from wagtail.models import GroupPagePermission, Page
     from wagtail.rich_text import RichText
 except ImportError:
     # Wagtail <5
-    from wagtail.core.models import Page
+    from wagtail.core.blocks import BlockWidget, CharBlock, ListBlock, PageChooserBlock, StreamBlock, StructBlock
+    from wagtail.core.models import GroupPagePermission, Page
     from wagtail.core.rich_text import RichText
+from wagtail.images.blocks import ImageChooserBlock
+from wagtail.search.backends import get_search_backend
+from wagtail.images.models import Image
 
 try:
     from wagtail.test.utils import WagtailPageTests, WagtailTestUtils
     from wagtail.test.utils.form_data import nested_form_data, streamfield
+    from wagtail.images.tests.utils import get_test_image_file
 except ImportError:
     # Wagtail <5
     from wagtail.tests.utils import WagtailPageTests, WagtailTestUtils
     from wagtail.tests.utils.form_data import nested_form_data, streamfield
+    from wagtail.images.tests.utils import get_test_image_file
 
 
 from html.parser import HTMLParser
 import json
+import re
+import shutil
+import tempfile
+import time
+from unittest import mock
 import urllib.parse
 import uuid
 
-from liveedit import views
+from liveedit import forms, side_effects, views
+from liveedit.utils import get_editor_cookie_settings, is_editor_cookie_present
+from liveedit.templatetags import liveedit as liveedit_tags
 
-from .models import TestPage
+from .models import TestPage, TestSnippet
 
 class MockRequest:
     def __init__(self, user):
         self.user = user
+        self.META = {}
 
 class BackendTestCase(WagtailPageTests, WagtailTestUtils):
  
@@ -139,6 +159,63 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
         parser.feed(ret)
         parser.check_tags()
 
+    def _count_render_queries(self, n):
+        page = TestPage()
+        page.title = "Long"
+        page.slug = 'long-%d' % n
+        page.body = json.dumps([
+            {'type': 'text', 'id':str(uuid.uuid4()), 'value': {
+                'body': "<p>Paragraph %d.</p>" % i
+            }} for i in range(n)
+        ])
+        self.root_page.add_child(instance=page)
+
+        # Render the latest (draft) revision, which involves the most checks
+        page.save_revision()
+        draft = TestPage.objects.get(pk=page.id).get_latest_revision_as_object()
+
+        with CaptureQueriesContext(connection) as queries:
+            ret = render_to_string(
+                "page.html",
+                {'page':draft},
+                request=MockRequest(self.user)
+            )
+
+        self.assertEqual(ret.count('data-liveedit='), n)
+        return len(queries)
+
+    def test_liveedit_attributes_query_count(self):
+        """
+        Test that the editing permission checks are only done once per object,
+        regardless of the number of blocks rendered.
+        """
+        self.assertEqual(
+            self._count_render_queries(2),
+            self._count_render_queries(50),
+        )
+
+    def test_include_block_autoescape(self):
+        stream_block = StreamBlock([
+            ('text', StructBlock([('body', CharBlock())], template="text_block.html")),
+        ])
+        value = stream_block.to_python([{'type': 'text', 'value': {'body': '<b>x</b>'}}])
+
+        # Block templates are autoescaped, even when included from a template
+        # which isn't
+        ret = Template(
+            "{% load liveedit %}{% autoescape off %}{% liveedit_include_block block %}{% endautoescape %}"
+        ).render(Context({'block': value[0]}))
+        self.assertIn('&lt;b&gt;x&lt;/b&gt;', ret)
+        self.assertNotIn('<b>', ret)
+
+    def test_include_block_value(self):
+        # Values other than bound blocks are rendered as with include_block
+        ret = Template(
+            "{% load liveedit %}{% liveedit_include_block block.value %}"
+        ).render(Context({'block': self.test_page.body[0]}))
+        self.assertIn('class="block-text"', ret)
+        self.assertIn('<h2>hello world</h2>', ret)
+
     def check_block_form(self, path, id=None):
         self.login(user=self.user)
 
@@ -176,6 +253,91 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
     def test_block_append_form(self):
         self.check_block_form('/__liveedit__/append-block/')
 
+    def test_admin_tags_cached(self):
+        """
+        Test that the admin base template is only rendered once, for opening
+        several edit panels, but that each panel gets its own CSRF token.
+        """
+        views._admin_tags_cache.clear()
+
+        with mock.patch.object(views, 'render_to_string', wraps=views.render_to_string) as rts:
+            self.check_block_form('/__liveedit__/edit-block/')
+            token = self.client.cookies['csrftoken'].value
+            self.client.cookies.clear()
+            self.check_block_form('/__liveedit__/edit-block/')
+
+        templates = [c.args[0] for c in rts.call_args_list]
+        self.assertEqual(templates.count("wagtailadmin/admin_base.html"), 1)
+        self.assertEqual(templates.count("liveedit/wagtail_config.html"), 2)
+        self.assertNotEqual(self.client.cookies['csrftoken'].value, token)
+
+    def test_admin_tags_manifest_changed(self):
+        """
+        Test that the admin tags are scraped again when the static files
+        manifest changes, replacing those scraped with the old one.
+        """
+        self.login(user=self.user)
+        views._admin_tags_cache.clear()
+
+        with mock.patch.object(views, 'render_to_string', wraps=views.render_to_string) as rts:
+            for signature in [(1, 100), (1, 100), (2, 100)]:
+                with mock.patch.object(views, '_static_manifest_signature', return_value=signature):
+                    self.client.get('/__liveedit__/panel/')
+
+        templates = [c.args[0] for c in rts.call_args_list]
+        self.assertEqual(templates.count("wagtailadmin/admin_base.html"), 2)
+        self.assertEqual(len(views._admin_tags_cache), 1)
+
+    def test_panel_prewarm(self):
+        """
+        Test that the prewarm panel includes the admin assets, but no block.
+        """
+        self.login(user=self.user)
+        views._admin_tags_cache.clear()
+
+        ret = self.client.get('/__liveedit__/panel/')
+        self.assertEqual(ret.status_code, 200)
+        content = ret.content.decode('utf-8')
+        self.assertIn('<script', content)
+        self.assertIn('rel="stylesheet"', content)
+        self.assertNotIn('data-block', content)
+
+    def test_block_edit_fragment(self):
+        """
+        Test that with the fragment parameter, just the form and its media are
+        returned, and saving returns the message for the page as JSON.
+        """
+        self.login(user=self.user)
+        query = urllib.parse.urlencode({
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':self.test_page.body[0].id,
+            'fragment':1,
+        })
+
+        with mock.patch.object(views, 'get_admin_tags') as get_admin_tags:
+            ret = self.client.get('/__liveedit__/edit-block/?' + query)
+        get_admin_tags.assert_not_called()
+        self.assertEqual(ret.status_code, 200)
+        result = ret.json()
+        self.assertIn('data-block', result['form_html'])
+        self.assertTrue(any('telepath' in tag for tag in result['media']['js']))
+        self.assertEqual(result['version'], self.rendered_version())
+        self.assertFalse(result['conflict'])
+
+        ret = self.client.post('/__liveedit__/edit-block/?' + query, {
+            'block_edit_form-body':json.dumps({
+                "blocks":[{
+                    "text":"This is the replacement rich text.",
+                }],
+            })
+        })
+        self.assertEqual(ret.json(), {'action':'rerender', 'id':self.test_page.body[0].id})
+
+        ret = self.client.get('/__liveedit__/append-block/?' + query)
+        self.assertIn('data-block', ret.json()['form_html'])
+
     def test_block_edit_nested_form(self):
         """
         Attempt to edit a block inside a streamblock in a listblock in a streamblock.
@@ -207,6 +369,42 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
 
         self.assertIn('<p>This is the replacement rich text.</p>', str(TestPage.objects.get(pk=self.test_page.id).body))
 
+    def test_block_render(self):
+        self.test_block_edit()
+
+        ret = self.client.get('/__liveedit__/render-block/', {
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':self.test_page.body[0].id,
+        })
+
+        result = ret.json()
+        self.assertFalse(result['reload'])
+        self.assertIn('<p>This is the replacement rich text.</p>', result['html'])
+        self.assertIn('data-liveedit=', result['html'])
+        self.assertIn(self.test_page.body[0].id, result['html'])
+
+    def test_block_render_context_processors(self):
+        stream_block = StreamBlock([
+            ('user', StructBlock([('body', CharBlock())], template="user_block.html")),
+        ])
+        value = stream_block.to_python([{'type': 'user', 'value': {'body': 'hello'}}])
+
+        # The re-rendered block sees the variables from context processors
+        html, reload = views.render_block(
+            MockRequest(self.user), self.test_page, self.content_type, 'body', value[0]
+        )
+        self.assertFalse(reload)
+        self.assertIn('administrator: hello', html)
+
+    def test_requires_reload(self):
+        request = MockRequest(self.user)
+        Template("{% load liveedit %}{% liveedit_requires_reload %}").render(
+            Context({'request': request})
+        )
+        self.assertTrue(request._live_edit_requires_reload)
+
     def test_block_edit_twice(self):
         # Should be no revisions at first
         self.assertEqual(self.test_page.revisions.count(), 0)
@@ -251,6 +449,440 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
         # Check that the live page has updated
         self.assertIn('<p>This is the replacement rich text.</p>', str(TestPage.objects.get(pk=self.test_page.id).body))
 
+    def test_block_edit_draft_patches_field(self):
+        # Create a draft with another change in it
+        self.test_page.title = "Draft title"
+        self.test_page.save_revision()
+
+        # Only the edited field should be loaded and re-serialised
+        self.login(user=self.user)
+        with mock.patch.object(TestPage, 'serializable_data') as serializable_data, \
+                mock.patch.object(TestPage, 'from_serializable_data', wraps=TestPage.from_serializable_data) as from_serializable_data:
+            self.client.post('/__liveedit__/edit-block/?' + urllib.parse.urlencode({
+                'content_type_id':self.content_type.id,
+                'object_id':self.test_page.id,
+                'object_field':'body',
+                'id':self.test_page.body[0].id,
+            }), {
+                'block_edit_form-body':json.dumps({
+                    "blocks":[{
+                        "text":"This is the replacement rich text.",
+                    }],
+                })
+            })
+            serializable_data.assert_not_called()
+            from_serializable_data.assert_not_called()
+
+            # but a block is rendered with the whole of the draft
+            self.client.get('/__liveedit__/render-block/', {
+                'content_type_id':self.content_type.id,
+                'object_id':self.test_page.id,
+                'object_field':'body',
+                'id':self.test_page.body[0].id,
+            })
+            from_serializable_data.assert_called_once()
+
+        draft = TestPage.objects.get(pk=self.test_page.id).get_latest_revision_as_object()
+        self.assertEqual(draft.title, "Draft title")
+        self.assertIn('<p>This is the replacement rich text.</p>', str(draft.body))
+        self.assertEqual([b.id for b in draft.body], [b.id for b in self.test_page.body])
+        # Check that the live page is unchanged
+        self.assertNotIn('<p>This is the replacement rich text.</p>', str(TestPage.objects.get(pk=self.test_page.id).body))
+
+    def count_revision_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.test_block_edit()
+        return len([
+            q for q in queries.captured_queries
+            if q['sql'].startswith('SELECT')
+            and 'FROM "wagtailcore_revision"' in q['sql']
+            and '"wagtailcore_revision"."content"' in q['sql']
+        ])
+
+    def test_block_edit_revision_queries(self):
+        # The latest revision should be loaded once (along with the page)
+        # whichever way the edit is saved.
+
+        # No revision yet, so a new one is created and published
+        publish = self.count_revision_queries()
+        # A recent revision by the same user, so it's merged into
+        merge = self.count_revision_queries()
+        # A draft, which is updated
+        self.test_page.save_revision()
+        draft = self.count_revision_queries()
+
+        # (publishing looks up the previous revision itself)
+        self.assertEqual(publish, 1)
+        self.assertEqual(merge, 0)
+        self.assertEqual(draft, 0)
+
+    def _edit_snippet(self, snippet, text):
+        self.login(user=self.user)
+
+        return self.client.post('/__liveedit__/edit-block/?' + urllib.parse.urlencode({
+            'content_type_id':ContentType.objects.get_for_model(TestSnippet).id,
+            'object_id':snippet.id,
+            'object_field':'body',
+            'id':snippet.body[0].id,
+        }), {
+            'block_edit_form-body':json.dumps({
+                "blocks":[{
+                    "text":text,
+                }],
+            })
+        })
+
+    def test_snippet_edit(self):
+        snippet = TestSnippet.objects.create(title="Snippet", body=json.dumps([
+            {'type': 'text', 'id':str(uuid.uuid4()), 'value': {
+                'body': "<p>Snippet text.</p>"
+            }},
+        ]))
+
+        # No revision yet, so a new one is created and published
+        self._edit_snippet(snippet, "Published text.")
+        snippet.refresh_from_db()
+        self.assertIn('<p>Published text.</p>', str(snippet.body))
+        self.assertIsNotNone(snippet.latest_revision)
+        self.assertEqual(snippet.live_revision, snippet.latest_revision)
+
+        # A recent revision by the same user, so only the field is updated
+        with CaptureQueriesContext(connection) as queries:
+            self._edit_snippet(snippet, "Merged text.")
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "tests_testsnippet"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"body"', updates[0])
+        self.assertNotIn('"title"', updates[0])
+        snippet.refresh_from_db()
+        self.assertIn('<p>Merged text.</p>', str(snippet.body))
+
+        # A draft, which is updated, leaving the live snippet unchanged
+        snippet.title = "Draft title"
+        snippet.save_revision(user=self.user)
+        self._edit_snippet(snippet, "Draft text.")
+        snippet.refresh_from_db()
+        self.assertIn('<p>Merged text.</p>', str(snippet.body))
+        draft = snippet.get_latest_revision_as_object()
+        self.assertEqual(draft.title, "Draft title")
+        self.assertIn('<p>Draft text.</p>', str(draft.body))
+
+    def test_snippet_draft_not_editable(self):
+        snippet = TestSnippet.objects.create(title="Snippet", body=json.dumps([]))
+        snippet.save_revision(user=self.user)
+
+        resolver = views.get_permission_resolver(MockRequest(self.user))
+        editable, draft_url = resolver.is_editing_allowed(snippet)
+        self.assertFalse(editable)
+        self.assertIsNone(draft_url)
+
+        editable, _ = resolver.is_editing_allowed(snippet.get_latest_revision_as_object())
+        self.assertTrue(editable)
+
+    def test_snippet_draft_no_notice(self):
+        snippet = TestSnippet.objects.create(title="Snippet", body=json.dumps([
+            {'type': 'text', 'id':str(uuid.uuid4()), 'value': {
+                'body': "<p>Snippet text.</p>"
+            }},
+        ]))
+        snippet.save_revision(user=self.user)
+
+        # A page including a snippet which has a draft isn't said to have a
+        # draft itself
+        ret = Template(
+            "{% load liveedit %}{% liveedit_include_block page.body.0 page 'body' %}"
+            "{% for block in snippet.body %}{% liveedit_include_block block snippet 'body' %}{% endfor %}"
+        ).render(Context({
+            'request': MockRequest(self.user),
+            'page': self.test_page,
+            'snippet': TestSnippet.objects.get(pk=snippet.pk),
+        }))
+        self.assertIn('<p>Snippet text.</p>', ret)
+        self.assertEqual(ret.count('data-liveedit='), 1)
+        self.assertNotIn('_live_edit_draft_url', ret)
+
+    def test_draft_mode(self):
+        self.login(user=self.user)
+        live_body = list(TestPage.objects.get(pk=self.test_page.id).body.raw_data)
+
+        with override_settings(LIVEEDIT_DRAFT_MODE=True):
+            self.assertTrue(self.client.get('/__liveedit__/draft-mode/').json()['draft_mode'])
+
+            # Both edits are saved into the same draft, leaving the live page alone
+            ret = self._edit_block(self.test_page.body[0], {
+                'block_edit_form-body':json.dumps({
+                    "blocks":[{
+                        "text":"This is the replacement rich text.",
+                    }],
+                }),
+            })
+            self._do_action(self.test_page.body[0].id, 'move_down')
+
+        page = TestPage.objects.get(pk=self.test_page.id)
+        self.assertTrue(page.has_unpublished_changes)
+        self.assertEqual(page.revisions.count(), 1)
+        self.assertEqual(list(page.body.raw_data), live_body)
+        self.assertIn('<p>This is the replacement rich text.</p>', str(page.get_latest_revision_as_object().body[1]))
+
+        # The frontend is told which revision to publish
+        self.assertIn('"revision_id": %d' % page.latest_revision_id, ret.content.decode('utf-8'))
+
+        ret = self.client.post('/__liveedit__/publish/', {
+            'objects': json.dumps([
+                {'content_type_id': self.content_type.id, 'object_id': self.test_page.id, 'revision_id': page.latest_revision_id},
+                {'content_type_id': self.content_type.id, 'object_id': self.empty_page.id, 'revision_id': 0},
+            ]),
+        })
+        self.assertEqual(ret.json()['published'], [{
+            'content_type_id': self.content_type.id,
+            'object_id': self.test_page.id,
+            'revision_id': page.latest_revision_id,
+        }])
+
+        page = TestPage.objects.get(pk=self.test_page.id)
+        self.assertFalse(page.has_unpublished_changes)
+        self.assertIn('<p>This is the replacement rich text.</p>', str(page.body[1]))
+
+    @override_settings(LIVEEDIT_DRAFT_MODE=True)
+    def test_draft_mode_reload(self):
+        ret = self._edit_block(self.test_page.body[0], {'delete': '1'})
+
+        # The page is reloaded as its draft, whose blocks can still be edited
+        page = TestPage.objects.get(pk=self.test_page.id)
+        draft_url = reverse('wagtailadmin_pages:revisions_view', args=(page.id, page.latest_revision_id))
+        self.assertIn('"url": "%s"' % draft_url, ret.content.decode('utf-8'))
+        self.assertEqual(ret.content.decode('utf-8').count('"action": "reload"'), 1)
+
+        ret = self.client.get(draft_url)
+        self.assertIn('data-liveedit=', ret.content.decode('utf-8'))
+
+        # As is the page after a move
+        ret = self.client.post('/__liveedit__/action/', {
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':self.test_page.body[1].id,
+            'redirect_url':'/test/#le-' + self.test_page.body[1].id,
+            'action':'move_down',
+        })
+        self.assertRedirects(ret, draft_url + '#le-' + self.test_page.body[1].id, fetch_redirect_response=False)
+
+    @override_settings(LIVEEDIT_DRAFT_MODE=True)
+    def test_publish_changed_draft(self):
+        self._do_action(self.test_page.body[0].id, 'move_down')
+        revision_id = TestPage.objects.get(pk=self.test_page.id).latest_revision_id
+
+        # Someone else saves a later draft in the admin, which isn't published
+        page = TestPage.objects.get(pk=self.test_page.id).get_latest_revision_as_object()
+        page.title = "Unreviewed"
+        page.save_revision(user=self.user_without_perms)
+
+        ret = self.client.post('/__liveedit__/publish/', {
+            'objects': json.dumps([
+                {'content_type_id': self.content_type.id, 'object_id': self.test_page.id, 'revision_id': revision_id},
+            ]),
+        })
+        self.assertEqual(ret.status_code, 409)
+        page = TestPage.objects.get(pk=self.test_page.id)
+        self.assertTrue(page.has_unpublished_changes)
+        self.assertEqual(page.title, "Test")
+
+        # The revision must be given
+        ret = self.client.post('/__liveedit__/publish/', {
+            'objects': json.dumps([
+                {'content_type_id': self.content_type.id, 'object_id': self.test_page.id},
+            ]),
+        })
+        self.assertEqual(ret.status_code, 400)
+
+    def test_publish_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+
+        ret = client.post('/__liveedit__/publish/', {'objects': '[]'})
+        self.assertEqual(ret.status_code, 403)
+        ret = client.post('/__liveedit__/draft-mode/', {'draft_mode': '1'})
+        self.assertEqual(ret.status_code, 403)
+
+        # The token is given to the frontend with the script, or in deferred
+        # mode, by the editable endpoint
+        ret = render_to_string("page.html", {'page': self.test_page}, request=MockRequest(self.user))
+        self.assertIn('data-csrf-token="', ret)
+        token = client.get('/__liveedit__/editable/', {'objects': '[]'}).json()['csrf_token']
+        ret = client.post('/__liveedit__/publish/', {'objects': '[]'}, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(ret.status_code, 200)
+
+    def test_block_batch_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        token = client.get('/__liveedit__/editable/', {'objects': '[]'}).json()['csrf_token']
+        data = {
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'operations': json.dumps([{'action': 'delete', 'id': self.test_page.body[0].id}]),
+        }
+
+        ret = client.post('/__liveedit__/batch/', data)
+        self.assertEqual(ret.status_code, 403)
+        self.assertEqual(len(TestPage.objects.get(pk=self.test_page.id).body), len(self.test_page.body))
+
+        # As are the frontend's moves
+        ret = client.post('/__liveedit__/action/', {
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':self.test_page.body[0].id,
+            'action':'move_down',
+            'format':'json',
+        })
+        self.assertEqual(ret.status_code, 403)
+
+        ret = client.post('/__liveedit__/batch/', data, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(len(TestPage.objects.get(pk=self.test_page.id).body), len(self.test_page.body) - 1)
+
+    def test_draft_mode_session(self):
+        self.login(user=self.user)
+
+        ret = self.client.post('/__liveedit__/draft-mode/', {'draft_mode': '1'})
+        self.assertTrue(ret.json()['draft_mode'])
+
+        # The page carries the toolbar's initial state, rather than the
+        # frontend having to ask for it
+        ret = render_to_string("page.html", {'page': self.test_page}, request=self.client.get('/__liveedit__/draft-mode/').wsgi_request)
+        self.assertIn('data-draft-mode="1"', ret)
+        self._edit_block(self.test_page.body[0], {
+            'block_edit_form-body':json.dumps({
+                "blocks":[{
+                    "text":"This is the replacement rich text.",
+                }],
+            }),
+        })
+        self.assertTrue(TestPage.objects.get(pk=self.test_page.id).has_unpublished_changes)
+
+        ret = self.client.post('/__liveedit__/draft-mode/', {'draft_mode': '0'})
+        self.assertFalse(ret.json()['draft_mode'])
+
+        ret = self.client.post('/__liveedit__/publish/', {'objects': '{}'})
+        self.assertEqual(ret.status_code, 400)
+
+    def _edit_block(self, block, data):
+        self.login(user=self.user)
+
+        return self.client.post('/__liveedit__/edit-block/?' + urllib.parse.urlencode({
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':block.id,
+        }), data)
+
+    def test_side_effects_deferred(self):
+        self.login(user=self.user)
+
+        search_backend = type(get_search_backend())
+        with mock.patch.object(search_backend, 'add') as add, \
+                mock.patch('wagtail.contrib.frontend_cache.signal_handlers.purge_page_from_cache') as purge:
+            with self.captureOnCommitCallbacks(execute=True):
+                self._edit_block(self.test_page.body[0], {
+                    'block_edit_form-body':json.dumps({
+                        "blocks":[{
+                            "text":"This is the replacement rich text.",
+                        }],
+                    }),
+                })
+
+                # Nothing is run until the transaction commits
+                add.assert_not_called()
+                purge.assert_not_called()
+
+        # Then the page is reindexed and purged once, although publishing it
+        # saves it more than once
+        add.assert_called_once()
+        self.assertEqual(add.call_args[0][0].pk, self.test_page.pk)
+        purge.assert_called_once()
+        self.assertEqual(purge.call_args[0][0].pk, self.test_page.pk)
+
+    def test_side_effects_coalesced(self):
+        backend = side_effects.ThreadBackend(delay=0.1)
+        with mock.patch.object(backend, 'run') as run:
+            backend.enqueue('tests', 'testpage', '1', frozenset(['index']))
+            backend.enqueue('tests', 'testpage', '1', frozenset(['purge']))
+            backend.enqueue('tests', 'testpage', '2', frozenset(['index']))
+
+            for i in range(50):
+                if run.call_count >= 2:
+                    break
+                time.sleep(0.1)
+            time.sleep(0.2)
+
+        self.assertEqual(run.call_count, 2)
+        run.assert_any_call('tests', 'testpage', '1', frozenset(['index', 'purge']))
+        run.assert_any_call('tests', 'testpage', '2', frozenset(['index']))
+
+    def test_block_edit_delta(self):
+        block = self.test_page.body[3]
+        item_id = block.value['items'][0].id
+
+        # Only the title is submitted, so the items shouldn't be cleaned
+        with mock.patch.object(StreamBlock, 'clean') as clean:
+            ret = self._edit_block(block, {
+                'block_edit_form-title':'A new title',
+                'liveedit_delta':json.dumps(['title']),
+            })
+            clean.assert_not_called()
+        self.assertEqual(ret.status_code, 200)
+
+        value = TestPage.objects.get(pk=self.test_page.id).body[3].value
+        self.assertEqual(value['title'], 'A new title')
+        self.assertEqual([b.id for b in value['items']], [item_id])
+        self.assertEqual(str(value['items'][0].value['body']), '<p>Testing</p>')
+
+    def test_block_edit_delta_errors(self):
+        ret = self._edit_block(self.test_page.body[4], {
+            'block_edit_form-text':'',
+            'liveedit_delta':json.dumps(['text']),
+        })
+
+        self.assertEqual(ret.status_code, 200)
+        self.assertIn(b'This field is required', ret.content)
+        self.assertEqual(
+            TestPage.objects.get(pk=self.test_page.id).body[4].value['text'],
+            'This is text',
+        )
+
+    def count_edit_form_queries(self, n):
+        block = StructBlock([
+            ('gallery', ListBlock(ImageChooserBlock())),
+            ('pages', ListBlock(PageChooserBlock())),
+        ])
+        block.set_name('chooser_test')
+        raw_value = {
+            'gallery': [image.id for image in self.images[:n]],
+            'pages': [self.test_page.id, self.empty_page.id] * n,
+        }
+
+        def render():
+            value = block.to_python(raw_value)
+            views.prefetch_chooser_data(block, value)
+            BlockWidget(block).render_with_errors('block_edit_form', value, errors=None)
+
+        render() # create the preview renditions
+        with CaptureQueriesContext(connection) as queries:
+            render()
+        return len(queries.captured_queries)
+
+    def test_edit_form_chooser_queries(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+
+        with override_settings(MEDIA_ROOT=media_root):
+            self.images = [
+                Image.objects.create(title="Image %d" % i, file=get_test_image_file())
+                for i in range(10)
+            ]
+            # The number of queries shouldn't depend on the number of chosen objects
+            self.assertEqual(self.count_edit_form_queries(2), self.count_edit_form_queries(10))
+
     def check_block_errors(self, path, data):
         self.login(user=self.user)
 
@@ -282,6 +914,39 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
             'block_edit_form-0-value-text': '',
         })
 
+    def test_block_append_nested(self):
+        """
+        Test inserting a block after one within a section.
+        """
+        self.login(user=self.user)
+        new_id = str(uuid.uuid4())
+
+        ret = self.client.post('/__liveedit__/append-block/?' + urllib.parse.urlencode({
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':self.test_page.body[2].value[0].id,
+        }), {
+            'block_edit_form-count': '1',
+            'block_edit_form-0-deleted': '',
+            'block_edit_form-0-order': '0',
+            'block_edit_form-0-type': 'text',
+            'block_edit_form-0-id': new_id,
+            'block_edit_form-0-value-body': json.dumps({
+                "blocks":[{
+                    "text":"An inserted text.",
+                }],
+            }),
+        })
+        self.assertEqual(ret.status_code, 200)
+
+        section = TestPage.objects.get(pk=self.test_page.id).body[2].value
+        self.assertEqual(
+            [child.id for child in section],
+            [self.test_page.body[2].value[0].id, new_id, self.test_page.body[2].value[1].id],
+        )
+        self.assertIn('An inserted text.', str(section[1].value['body']))
+
     def _do_action(self, block_id, action):
         self.login(user=self.user)
 
@@ -314,6 +979,219 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
             block_id,
         )
 
+    def test_block_move_down_nested(self):
+        block_id = self.test_page.body[2].value[0].id
+        body = self._do_action(block_id, 'move_down')
+
+        self.assertEqual(
+            body[2].value[1].id,
+            block_id,
+        )
+
+    def test_block_move_redirect(self):
+        self.login(user=self.user)
+        data = {
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':self.test_page.body[0].id,
+            'action':'move_down',
+        }
+
+        # Without a redirect_url, the referring page is returned to
+        ret = self.client.post('/__liveedit__/action/', data, HTTP_REFERER='/test/')
+        self.assertRedirects(ret, '/test/', fetch_redirect_response=False)
+
+        # Or if there isn't one, nothing is done
+        ret = self.client.post('/__liveedit__/action/', data)
+        self.assertEqual(ret.status_code, 400)
+        self.assertEqual(TestPage.objects.get(pk=self.test_page.id).body[1].id, self.test_page.body[0].id)
+
+    def test_block_move_json(self):
+        self.login(user=self.user)
+
+        ids = [b.id for b in self.test_page.body]
+        ret = self.client.post('/__liveedit__/action/', {
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':ids[1],
+            'action':'move_up',
+            'format':'json',
+        })
+
+        self.assertEqual(ret.status_code, 200)
+        result = ret.json()
+        self.assertTrue(result['moved'])
+        self.assertEqual(result['order'], [ids[1], ids[0]] + ids[2:])
+        self.assertEqual(result['affected'], [ids[1], ids[0]])
+        self.assertEqual(
+            result['revision_id'],
+            TestPage.objects.get(pk=self.test_page.id).latest_revision_id,
+        )
+        self.assertEqual(TestPage.objects.get(pk=self.test_page.id).body[0].id, ids[1])
+
+    def rendered_version(self):
+        page = TestPage.objects.get(pk=self.test_page.id)
+        ret = render_to_string("page.html", {'page': page}, request=MockRequest(self.user))
+        versions = set(re.findall(r'&quot;version&quot;: &quot;(\w+)&quot;', ret))
+        self.assertEqual(len(versions), 1)
+        return versions.pop()
+
+    def test_block_move_version(self):
+        self.login(user=self.user)
+
+        ids = [b.id for b in self.test_page.body]
+        version = self.rendered_version()
+
+        def move_up(version):
+            return self.client.post('/__liveedit__/action/', {
+                'content_type_id':self.content_type.id,
+                'object_id':self.test_page.id,
+                'object_field':'body',
+                'id':ids[1],
+                'action':'move_up',
+                'format':'json',
+                'version':version,
+            })
+
+        ret = move_up(version)
+        self.assertEqual(ret.status_code, 200)
+        # the new version should match the blocks as rendered from now on
+        new_version = ret.json()['version']
+        self.assertNotEqual(new_version, version)
+        self.assertEqual(new_version, self.rendered_version())
+
+        # moving again based on the original version conflicts
+        ret = move_up(version)
+        self.assertEqual(ret.status_code, 409)
+        result = ret.json()
+        self.assertTrue(result['conflict'])
+        self.assertEqual(result['version'], new_version)
+        self.assertIn(ids[1], result['html'])
+        self.assertEqual(TestPage.objects.get(pk=self.test_page.id).body[0].id, ids[1])
+
+    def test_block_edit_conflict(self):
+        self.login(user=self.user)
+
+        version = self.rendered_version()
+        # someone else changes the blocks
+        self._do_action(self.test_page.body[1].id, 'move_up')
+
+        ret = self.client.post('/__liveedit__/edit-block/?' + urllib.parse.urlencode({
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'id':self.test_page.body[0].id,
+        }), {
+            'block_edit_form-body':json.dumps({
+                "blocks":[{
+                    "text":"This is the replacement rich text.",
+                }],
+            }),
+            'version':version,
+        })
+
+        self.assertEqual(ret.status_code, 409)
+        self.assertIn(self.rendered_version(), ret.content.decode())
+        self.assertNotIn('<p>This is the replacement rich text.</p>', str(TestPage.objects.get(pk=self.test_page.id).body))
+
+    def _do_batch(self, operations, **data):
+        self.login(user=self.user)
+
+        return self.client.post('/__liveedit__/batch/', {
+            'content_type_id':self.content_type.id,
+            'object_id':self.test_page.id,
+            'object_field':'body',
+            'operations':json.dumps(operations),
+            **data,
+        })
+
+    def test_block_batch(self):
+        ids = [b.id for b in self.test_page.body]
+        nested_ids = [b.id for b in self.test_page.body[2].value]
+
+        ret = self._do_batch([
+            {'action':'move', 'id':ids[0], 'index':3},
+            {'action':'delete', 'id':ids[1]},
+            {'action':'duplicate', 'id':ids[2]},
+            {'action':'reorder', 'ids':nested_ids[::-1]},
+        ])
+        self.assertEqual(ret.status_code, 200)
+        result = ret.json()
+        self.assertEqual([r['changed'] for r in result['results']], [True, True, True, True])
+        duplicate_id = result['results'][2]['id']
+
+        # saved once, as a single revision
+        self.assertEqual(self.test_page.revisions.count(), 1)
+
+        body = TestPage.objects.get(pk=self.test_page.id).body
+        self.assertEqual(
+            [b.id for b in body],
+            [ids[2], duplicate_id, ids[3], ids[0]] + ids[4:],
+        )
+        self.assertEqual([b.id for b in body[0].value], nested_ids[::-1])
+        # the copy and the blocks within it get new ids
+        self.assertEqual(len(body[1].value), len(nested_ids))
+        self.assertFalse({b.id for b in body[1].value} & set(nested_ids))
+        self.assertEqual(str(body[1].value[0].value['body']), str(body[0].value[1].value['body']))
+
+    def test_block_batch_invalid(self):
+        ids = [b.id for b in self.test_page.body]
+
+        for operations in [
+            [{'action':'move', 'id':ids[0], 'index':3}, {'action':'delete', 'id':'missing'}],
+            [{'action':'move', 'id':ids[0]}],
+            [{'action':'explode', 'id':ids[0]}],
+            [{'action':'reorder', 'ids':ids[:2]}],
+        ]:
+            ret = self._do_batch(operations)
+            self.assertEqual(ret.status_code, 400)
+
+        ret = self._do_batch([{'action':'delete', 'id':ids[0]}], version='stale')
+        self.assertEqual(ret.status_code, 409)
+
+        # nothing should have been saved
+        self.assertEqual(
+            [b.id for b in TestPage.objects.get(pk=self.test_page.id).body],
+            ids,
+        )
+
+    def test_index_blocks(self):
+        body = self.test_page.body
+        index = views.index_blocks(body.raw_data)
+
+        self.assertEqual(index[body[0].id], (0,))
+        self.assertEqual(index[body[2].value[1].id], (2, 1))
+        self.assertEqual(index[body[3].value['items'][0].id], (3, 'items', 0))
+        self.assertEqual(index[body[5].value['columns'][0][1].id], (5, 'columns', 0, 1))
+
+        block, value, _, parent_block = views.find_block(body, body[5].value['columns'][0][1].id)
+        self.assertEqual(block.name, 'text')
+        self.assertIn('A second text inside a column.', str(value['body']))
+        self.assertIs(parent_block, body[5].block.child_blocks['columns'].child_block)
+
+    def test_find_block_lazy(self):
+        """
+        Test that finding and changing a block doesn't convert the values of
+        any other blocks, but that the change is saved.
+        """
+        page = TestPage.objects.get(pk=self.test_page.id)
+        body = page.body
+        block_id = self.test_page.body[5].value['columns'][0][1].id
+
+        block, value, set_value, _ = views.find_block(body, block_id)
+        self.assertEqual(body._bound_blocks, [None] * len(body))
+
+        value['body'] = RichText('<p>Changed.</p>')
+        set_value(value)
+        self.assertEqual(body._bound_blocks, [None] * len(body))
+
+        page.save()
+        page = TestPage.objects.get(pk=self.test_page.id)
+        self.assertEqual(str(page.body[5].value['columns'][0][1].value['body']), '<p>Changed.</p>')
+        self.assertEqual(page.body[5].value['columns'][0][1].id, block_id)
+
     def test_block_delete(self):
         self.login(user=self.user)
 
@@ -366,6 +1244,21 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
         )
         self.assertNotIn('data-liveedit', ret)
 
+    def test_unauthenticated_checked_once(self):
+        """
+        Test that whether liveedit is enabled is only checked once per request,
+        rather than once per block.
+        """
+        with mock.patch.object(liveedit_tags, 'is_enabled', return_value=True) as is_enabled:
+            ret = render_to_string(
+                "page.html",
+                {'page':self.test_page},
+                request=MockRequest(AnonymousUser())
+            )
+        self.assertEqual(is_enabled.call_count, 1)
+        self.assertNotIn('data-liveedit', ret)
+        self.assertNotIn('liveedit.js', ret)
+
     def test_unauthenticated_empty_page(self):
         """
         Test that the liveedit attributes are not added when the user is not
@@ -379,6 +1272,141 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
         )
         self.assertNotIn('data-liveedit', ret)
 
+    def test_editor_cookie(self):
+        """
+        Test that the "editor present" cookie is set for admin users once their
+        session has been loaded, and removed on logout.
+        """
+        name, _, _ = get_editor_cookie_settings()
+        factory = RequestFactory()
+
+        self.assertFalse(is_editor_cookie_present(factory.get('/page/')))
+
+        self.login(user=self.user)
+        self.client.get('/admin/')
+        self.assertIn(name, self.client.cookies)
+
+        request = factory.get('/page/')
+        request.COOKIES[name] = self.client.cookies[name].value
+        self.assertTrue(is_editor_cookie_present(request))
+
+        request.COOKIES[name] = '1'
+        self.assertFalse(is_editor_cookie_present(request))
+
+        self.client.post('/admin/logout/')
+        self.assertEqual(self.client.cookies[name].value, '')
+
+    def test_editor_cookie_not_for_other_users(self):
+        name, _, _ = get_editor_cookie_settings()
+
+        self.client.force_login(self.create_user(username='visitor', password='password'))
+        self.client.get('/admin/')
+        self.assertNotIn(name, self.client.cookies)
+
+    @override_settings(LIVEEDIT_DEFERRED=True)
+    def test_deferred(self):
+        """
+        Test that in deferred mode, pages are rendered identically for editors
+        and anonymous visitors, with block markers.
+        """
+        ret = render_to_string(
+            "page.html",
+            {'page':self.test_page},
+            request=MockRequest(self.user)
+        )
+        self.assertEqual(ret, render_to_string(
+            "page.html",
+            {'page':self.test_page},
+            request=MockRequest(AnonymousUser())
+        ))
+        self.assertNotIn('data-liveedit=', ret)
+        self.assertIn('data-liveedit-marker=', ret)
+        self.assertIn('data-deferred="1"', ret)
+
+        # Anonymous visitors don't ask which blocks are editable, since they
+        # don't have the "editor present" cookie
+        self.assertIn('data-editor-cookie="%s"' % get_editor_cookie_settings()[0], ret)
+
+    def check_editable(self, page, **data):
+        return self.client.get('/__liveedit__/editable/', {
+            'objects': json.dumps([{
+                'content_type_id':self.content_type.id,
+                'object_id':page.id,
+                'object_field':'body',
+                **data,
+            }]),
+        }).json()['objects'][0]
+
+    @override_settings(LIVEEDIT_DEFERRED=True)
+    def test_deferred_editable(self):
+        self.login(user=self.user)
+        self.assertEqual(self.check_editable(self.test_page), {'editable': True, 'draft_url': None})
+
+        # With a draft, only the latest revision is editable
+        revision = self.test_page.save_revision()
+        state = self.check_editable(self.test_page)
+        self.assertFalse(state['editable'])
+        self.assertIn('/%d/' % revision.id, state['draft_url'])
+        self.assertTrue(self.check_editable(self.test_page, revision_id=revision.id)['editable'])
+
+        self.login(user=self.user_without_perms)
+        self.assertFalse(self.check_editable(self.test_page)['editable'])
+
+    def create_editor(self):
+        # An editor without superuser status, whose permissions are looked up
+        editor = self.create_user(username='editor', password='password', is_staff=True)
+        group = Group.objects.create(name='Live editors')
+        group.permissions.add(
+            Permission.objects.get(content_type__app_label='wagtailadmin', codename='access_admin')
+        )
+        if hasattr(GroupPagePermission, 'permission_type'):
+            # Wagtail <5.1
+            GroupPagePermission.objects.create(group=group, page=self.root_page, permission_type='edit')
+        else:
+            GroupPagePermission.objects.create(
+                group=group,
+                page=self.root_page,
+                permission=Permission.objects.get(content_type__app_label='wagtailcore', codename='change_page'),
+            )
+        editor.groups.add(group)
+        return editor
+
+    def count_editable_queries(self, n):
+        pages = []
+        for i in range(n):
+            page = TestPage()
+            page.title = "Page %d" % i
+            page.slug = 'page-%d-%d' % (n, i)
+            page.body = json.dumps([])
+            self.root_page.add_child(instance=page)
+            if i % 2:
+                # Half of them have drafts, which are looked up too
+                page.save_revision()
+            pages.append(page)
+
+        with CaptureQueriesContext(connection) as queries:
+            ret = self.client.get('/__liveedit__/editable/', {
+                'objects': json.dumps([{
+                    'content_type_id':self.content_type.id,
+                    'object_id':page.id,
+                    'object_field':'body',
+                } for page in pages]),
+            })
+
+        objects = ret.json()['objects']
+        self.assertEqual(len(objects), n)
+        self.assertEqual(sum(1 for state in objects if state['editable']), (n + 1) // 2)
+        self.assertEqual(sum(1 for state in objects if state['draft_url']), n // 2)
+        return len(queries)
+
+    def test_editable_query_count(self):
+        """
+        Test that resolving the editable state of many objects together takes
+        the same number of queries as for a few.
+        """
+        self.login(user=self.create_editor())
+        self.assertEqual(self.count_editable_queries(2), self.count_editable_queries(10))
+
     def test_insufficient_permission(self):
         self.login(user=self.user_without_perms)
 
@@ -398,3 +1426,13 @@ class BackendTestCase(WagtailPageTests, WagtailTestUtils):
         self.assertEqual(ret.status_code, 400)
         self.assertIn(b"Permission denied", ret.content)
 
+    def test_editable_fields_cached(self):
+        forms.check_can_edit(self.user, self.test_page, 'body')
+
+        with mock.patch.object(TestPage, 'get_edit_handler') as get_edit_handler:
+            forms.check_can_edit(self.user, self.test_page, 'body')
+            # a field not on the edit panels
+            with self.assertRaises(PermissionDenied):
+                forms.check_can_edit(self.user, self.test_page, 'draft_title')
+            get_edit_handler.assert_not_called()
+
@@ -0,0 +1,96 @@
+from django.contrib.auth.models import AnonymousUser
+from django.template import Context, Template
+
+try:
+    from wagtail.models import Page
+    from wagtail.test.utils import WagtailPageTests, WagtailTestUtils
+except ImportError:
+    # Wagtail <5
+    from wagtail.core.models import Page
+    from wagtail.tests.utils import WagtailPageTests, WagtailTestUtils
+
+import json
+import os
+import timeit
+import unittest
+import uuid
+
+from .models import TestPage
+
+BLOCKS = 200
+
+INCLUDE_BLOCK = Template(
+    "{% load wagtailcore_tags %}"
+    "{% for block in page.body %}{% include_block block %}{% endfor %}"
+)
+
+LIVEEDIT_INCLUDE_BLOCK = Template(
+    "{% load liveedit %}"
+    "{% for block in page.body %}"
+    "{% liveedit_include_block block object=page field='body' %}"
+    "{% endfor %}"
+)
+
+class MockRequest:
+    def __init__(self, user):
+        self.user = user
+
+@unittest.skipUnless(os.getenv('LIVEEDIT_BENCHMARKS'), "set LIVEEDIT_BENCHMARKS=1 to run benchmarks")
+class BenchmarkTestCase(WagtailPageTests, WagtailTestUtils):
+    """
+    Compare the time taken to render a page's blocks with
+    `liveedit_include_block` against Wagtail's plain `include_block`, with a
+    large template context (as a site with menus, settings etc. would have).
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = self.create_superuser(
+            username='administrator',
+            email='administrator@email.com',
+            password='password'
+        )
+
+        self.page = TestPage()
+        self.page.title = "Benchmark"
+        self.page.slug = 'benchmark'
+        self.page.body = json.dumps([
+            {'type': 'text', 'id':str(uuid.uuid4()), 'value': {
+                'body': "<p>Paragraph %d.</p>" % i
+            }} for i in range(BLOCKS)
+        ])
+        Page.objects.get(pk=1).add_child(instance=self.page)
+
+    def render_time(self, template, user):
+        def render():
+            context = Context({
+                'page': self.page,
+                'request': MockRequest(user),
+            })
+            # simulate a large context, built up from several layers
+            for layer in range(10):
+                context.update({'var_%d_%d' % (layer, i): i for i in range(50)})
+            template.render(context)
+
+        render() # warm up template loading and block value conversion
+        return min(timeit.repeat(render, number=5, repeat=5)) / 5
+
+    def report(self, name, seconds, baseline):
+        print("\n%-40s %6.1fus per block (%+.1f%%)" % (
+            name,
+            seconds / BLOCKS * 1e6,
+            (seconds / baseline - 1) * 100,
+        ))
+
+    def test_render(self):
+        baseline = self.render_time(INCLUDE_BLOCK, AnonymousUser())
+        self.report("include_block", baseline, baseline)
+
+        anonymous = self.render_time(LIVEEDIT_INCLUDE_BLOCK, AnonymousUser())
+        self.report("liveedit_include_block (anonymous)", anonymous, baseline)
+        # anonymous visitors should see practically no overhead
+        self.assertLess(anonymous, baseline * 1.05)
+
+        editor = self.render_time(LIVEEDIT_INCLUDE_BLOCK, self.user)
+        self.report("liveedit_include_block (editor)", editor, baseline)